@@ -4,10 +4,33 @@ Created on Sat Oct 24 19:57:22 2020
 @author: Pina
 """
 
+from multiprocessing import Pool
+
 import nltk
 from nltk import FreqDist
 from nltk.corpus import stopwords
 
+_STOP_WORDS = None
+
+
+def get_stop_words():
+    """English stop words as a frozenset, loaded once per process.
+    The corpus is downloaded only if it is not installed yet."""
+    global _STOP_WORDS
+    if _STOP_WORDS is None:
+        try:
+            words = stopwords.words("english")
+        except LookupError:
+            nltk.download("stopwords")
+            words = stopwords.words("english")
+        _STOP_WORDS = frozenset(words)
+    return _STOP_WORDS
+
+
+def _tokenize(text):
+    tokens = Article.txt_to_tokens(text)
+    return tokens, FreqDist(tokens)
+
 
 class Article:
     def __init__(self, text):
@@ -28,10 +51,25 @@ class Article:
     def txt_to_tokens(text):
         """Split text and filter words containing only letters"""
 
-        tokens = [
-            x for x in filter(lambda x: x.isalpha(), text.lower().split())
-        ]
-        nltk.download("stopwords")
-        sr = stopwords.words("english")
+        sr = get_stop_words()
         # throwing out 'stop words'
-        return [x for x in filter(lambda x: x not in sr, tokens)]
+        return [x for x in text.lower().split() if x.isalpha() and x not in sr]
+
+    @classmethod
+    def tokenize_many(cls, texts, processes=None, chunksize=64):
+        """Create tokenized articles from many texts using a process pool.
+        Same as calling tokenize() on every article, but tokens and
+        frequencies are computed in `processes` worker processes."""
+
+        # load before forking so the workers inherit the stop words
+        get_stop_words()
+        texts = list(texts)
+        with Pool(processes) as pool:
+            results = pool.map(_tokenize, texts, chunksize=chunksize)
+        articles = []
+        for text, (tokens, freq) in zip(texts, results):
+            article = cls(text)
+            article.tokens = tokens
+            article.freq = freq
+            articles.append(article)
+        return articles
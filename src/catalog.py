@@ -0,0 +1,140 @@
+"""
+Catalog of the documents in clean_data, kept in SQLite next to the folder
+(clean_data.catalog.db), so the scripts do not have to walk the year/month
+tree with os.listdir every time and all of them see the documents in the
+same order: by year, month and file name.
+
+Only month folders whose modification time changed since the last refresh
+(a file was added, removed or renamed) are listed again, so a refresh
+costs one stat per folder. A file rewritten in place does not change its
+folder, refresh(full=True) also compares the size and mtime of every
+file in the other folders with the catalog.
+"""
+import os
+import sqlite3
+
+import pandas as pd
+
+COLUMNS = ["doc_id", "year", "month", "title", "filename", "size", "mtime"]
+
+
+def default_db_path(clean_data_dir: str) -> str:
+    return os.path.normpath(clean_data_dir) + ".catalog.db"
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(db_path)
+    with connection:
+        connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS documents (
+                doc_id TEXT PRIMARY KEY,
+                year INTEGER NOT NULL,
+                month INTEGER NOT NULL,
+                title TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL
+            )
+            """
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS documents_order ON documents (year, month, filename)"
+        )
+        connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS folders (
+                folder TEXT PRIMARY KEY,
+                mtime REAL NOT NULL
+            )
+            """
+        )
+    return connection
+
+
+def _month_folders(clean_data_dir: str):
+    for year in os.scandir(clean_data_dir):
+        if year.is_dir() and year.name.isdigit():
+            for month in os.scandir(year.path):
+                if month.is_dir() and month.name.isdigit():
+                    yield year.name, month.name, month.path, month.stat().st_mtime
+
+
+def refresh(clean_data_dir: str, db_path: str = None, full: bool = False) -> None:
+    """
+    Bring the catalog up to date with clean_data.
+    :param clean_data_dir: path to clean_data folder
+    :param db_path: sqlite file, clean_data.catalog.db by default
+    :param full: also check every file of unchanged folders, for files rewritten in place
+    """
+    connection = connect(db_path or default_db_path(clean_data_dir))
+    with connection:
+        known = dict(connection.execute("SELECT folder, mtime FROM folders"))
+        seen = set()
+        for year, month, month_path, mtime in _month_folders(clean_data_dir):
+            folder = f"{year}/{month}"
+            seen.add(folder)
+            if known.get(folder) == mtime and not full:
+                continue
+            rows = []
+            for entry in os.scandir(month_path):
+                if entry.is_file() and not entry.name.startswith("."):
+                    stat = entry.stat()
+                    rows.append(
+                        (
+                            f"{folder}/{entry.name}",
+                            int(year),
+                            int(month),
+                            os.path.splitext(entry.name)[0],
+                            entry.name,
+                            stat.st_size,
+                            stat.st_mtime,
+                        )
+                    )
+            if known.get(folder) == mtime:
+                # same files, only those rewritten in place are updated
+                stored = {
+                    doc_id: (size, file_mtime)
+                    for doc_id, size, file_mtime in connection.execute(
+                        "SELECT doc_id, size, mtime FROM documents WHERE doc_id LIKE ?", (folder + "/%",)
+                    )
+                }
+                changed = [row for row in rows if stored.get(row[0]) != (row[5], row[6])]
+                connection.executemany(
+                    "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)", changed
+                )
+                continue
+            connection.execute("DELETE FROM documents WHERE doc_id LIKE ?", (folder + "/%",))
+            connection.executemany(
+                "INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO folders (folder, mtime) VALUES (?, ?)", (folder, mtime)
+            )
+        for folder in set(known) - seen:
+            connection.execute("DELETE FROM documents WHERE doc_id LIKE ?", (folder + "/%",))
+            connection.execute("DELETE FROM folders WHERE folder = ?", (folder,))
+    connection.close()
+
+
+def get_documents(clean_data_dir: str, db_path: str = None, update: bool = True, full: bool = False) -> pd.DataFrame:
+    """
+    Documents of clean_data ordered by year, month and file name.
+    :param clean_data_dir: path to clean_data folder
+    :param db_path: sqlite file, clean_data.catalog.db by default
+    :param update: refresh the catalog before reading it
+    :param full: refresh every file, not only the changed folders, see refresh
+    :return: dataframe with columns doc_id, year, month, title, filename, path, size, mtime
+    """
+    db_path = db_path or default_db_path(clean_data_dir)
+    if update:
+        refresh(clean_data_dir, db_path, full)
+    connection = connect(db_path)
+    documents = pd.read_sql_query(
+        f"SELECT {', '.join(COLUMNS)} FROM documents ORDER BY year, month, filename",
+        connection,
+    )
+    connection.close()
+    # doc_id is the path relative to clean_data
+    documents["path"] = [os.path.join(clean_data_dir, *doc_id.split("/")) for doc_id in documents.doc_id]
+    return documents
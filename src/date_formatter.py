@@ -1,8 +1,10 @@
-from date_extractor import extract_date
-from os import path, listdir, path, mkdir
-import time
+from os import path, listdir, makedirs, cpu_count
+import argparse
+import csv
 import logging
+import re
 import shutil
+from multiprocessing import Pool
 from PyPDF2 import PdfFileReader
 from PyPDF2.utils import PdfReadError
 
@@ -18,51 +20,124 @@ logging.basicConfig(
 logger = logging.getLogger("pdfminer")
 logger.propagate = False
 
-# Basically we will extract the creation date of every pdf from their metadata
-# and sort them accordingly
-for pdf_file in listdir("../data"):
-    if path.isfile(f"../data/{pdf_file}"):
-        try:
-            pdf_toread = PdfFileReader(open(f"../data/{pdf_file}", "rb"))
-            if pdf_toread.isEncrypted:
-                pdf_toread.decrypt("")
-            pdf_info = pdf_toread.getDocumentInfo()
-            pdf_date = pdf_info.get("/CreationDate").split(":")[1].split("+")[0]
-            pdf_year = int(pdf_date[0:4])
-            pdf_months = int(pdf_date[5:6])
-            if (
-                pdf_year > 2014 and pdf_months != None
-            ):  # for now we are sticking with papers published after 2014
-                if not path.isdir(f"../data/{pdf_year}"):
-                    mkdir(f"../data/{pdf_year}")
-                    mkdir(f"../data/{pdf_year}/{pdf_months}")
-                    shutil.move(
-                        f"../data/{pdf_file}",
-                        f"../data/{pdf_year}/{pdf_months}/{pdf_file}",
-                    )
-
-                else:
-                    if not path.isdir(f"../data/{pdf_year}/{pdf_months}"):
-                        mkdir(f"../data/{pdf_year}/{pdf_months}")
-                        shutil.move(
-                            f"../data/{pdf_file}",
-                            f"../data/{pdf_year}/{pdf_months}/{pdf_file}",
-                        )
-                    else:
-                        shutil.move(
-                            f"../data/{pdf_file}",
-                            f"../data/{pdf_year}/{pdf_months}/{pdf_file}",
-                        )
-                        time.sleep(0.2)  # so that the CPU does not fry
-        except (
-            IndexError,
-            AttributeError,
-            PdfReadError,
-            TypeError,
-            KeyError,
-            NotImplementedError,
-            ValueError,
-            AssertionError,
-            FileNotFoundError,
+# D:YYYYMMDDHHmmSSOHH'mm' with everything after the year optional
+PDF_DATE = re.compile(r"^(?:D:)?(\d{4})(\d{2})?")
+
+PARSE_ERRORS = (
+    IndexError,
+    AttributeError,
+    PdfReadError,
+    TypeError,
+    KeyError,
+    NotImplementedError,
+    ValueError,
+    AssertionError,
+    OSError,
+)
+
+
+def parse_pdf_date(pdf_date):
+    """
+    Returns (year, month) of a PDF date string, month is None if missing
+    """
+
+    match = PDF_DATE.match(pdf_date.strip())
+    if not match:
+        raise ValueError(f"not a PDF date: {pdf_date!r}")
+    year = int(match.group(1))
+    month = int(match.group(2)) if match.group(2) else None
+    if month is not None and not 1 <= month <= 12:
+        raise ValueError(f"not a PDF date: {pdf_date!r}")
+    return year, month
+
+
+def read_creation_date(pdf_path):
+    """
+    Returns (year, month) of /CreationDate in the Info dictionary.
+    Only the cross reference table, the trailer and the Info object
+    are read, pages are never parsed. The file is closed on return.
+    """
+
+    with open(pdf_path, "rb") as pdf:
+        pdf_toread = PdfFileReader(pdf, strict=False)
+        if pdf_toread.isEncrypted:
+            pdf_toread.decrypt("")
+        pdf_info = pdf_toread.getDocumentInfo()
+        return parse_pdf_date(pdf_info.get("/CreationDate"))
+
+
+def _date_of(pdf_path):
+    try:
+        return (pdf_path,) + read_creation_date(pdf_path)
+    except PARSE_ERRORS:
+        return pdf_path, None, None
+
+
+def index_dates(data_dir="../data", workers=cpu_count()):
+    """
+    Returns [(file name, year, month)] for every pdf directly in data_dir,
+    year and month are None when the date could not be parsed
+    """
+
+    pdf_paths = [
+        path.join(data_dir, pdf_file)
+        for pdf_file in listdir(data_dir)
+        if path.isfile(path.join(data_dir, pdf_file))
+    ]
+    index = []
+    with Pool(workers) as pool:
+        for pdf_path, year, month in pool.imap_unordered(
+            _date_of, pdf_paths, chunksize=32
         ):
-            mylogger.critical(f"Could not parse date for {pdf_file}")
+            if year is None:
+                mylogger.critical(f"Could not parse date for {path.basename(pdf_path)}")
+            index.append((path.basename(pdf_path), year, month))
+    index.sort()
+    return index
+
+
+def write_index(index, index_path):
+    with open(index_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["file", "year", "month"])
+        writer.writerows(index)
+
+
+def move_pdfs(index, data_dir="../data", min_year=2015):
+    """
+    Moves every indexed pdf to data_dir/year/month
+    """
+
+    for pdf_file, pdf_year, pdf_month in index:
+        # for now we are sticking with papers published after 2014
+        if pdf_year is None or pdf_month is None or pdf_year < min_year:
+            continue
+        makedirs(path.join(data_dir, str(pdf_year), str(pdf_month)), exist_ok=True)
+        shutil.move(
+            path.join(data_dir, pdf_file),
+            path.join(data_dir, str(pdf_year), str(pdf_month), pdf_file),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sort the pdfs in the data folder into year/month folders "
+        "using the creation date from their metadata"
+    )
+    parser.add_argument("--data-dir", default="../data")
+    parser.add_argument("--workers", type=int, default=cpu_count())
+    parser.add_argument("--index", default="date_index.csv", help="date index written before any move")
+    parser.add_argument("--min-year", type=int, default=2015)
+    parser.add_argument("--index-only", action="store_true", help="do not move any file")
+    args = parser.parse_args()
+
+    # Basically we will extract the creation date of every pdf from their metadata
+    # and sort them accordingly
+    index = index_dates(args.data_dir, args.workers)
+    write_index(index, args.index)
+    if not args.index_only:
+        move_pdfs(index, args.data_dir, args.min_year)
+
+
+if __name__ == "__main__":
+    main()
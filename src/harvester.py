@@ -0,0 +1,123 @@
+"""
+Listing sources for the scraper, the scraper decides where to save the
+papers. iter_listing yields (arxiv_id, title, url) for the papers of one
+month, iter_oai_records yields (arxiv_id, title, url, year, month) for a
+date range, with the month the paper belongs to taken from its id.
+
+Every function takes the `get` used to send requests, so the rate
+limit and the session of the scraper are shared, and a `base_url`
+so it can be pointed at a local server.
+"""
+
+import re
+import time
+from xml.etree import ElementTree as Et
+
+from bs4 import BeautifulSoup
+
+OAI = "{http://www.openarchives.org/OAI/2.0/}"
+ARXIV = "{http://arxiv.org/OAI/arXiv/}"
+TOTAL_ENTRIES = re.compile(r"total of (\d+) entries")
+
+
+def id_to_date(arxiv_id):
+    """
+    (year, month) encoded in an arXiv id, both for new style ids
+    (1807.01234) and old style ones (cs/0701001)
+    """
+
+    number = arxiv_id.split("/")[-1]
+    return 2000 + int(number[0:2]), int(number[2:4])
+
+
+def parse_listing(html):
+    """
+    Returns (arxiv_id, title, pdf link) of every paper on one listing
+    page together with the total number of entries of the month
+    (None when the page does not say)
+    """
+
+    page_soup = BeautifulSoup(html, "html.parser")
+    pdf_titles = page_soup.findAll("dd")
+    pdf_links = page_soup.findAll("dt")
+    entries = []
+    for title, link in zip(pdf_titles, pdf_links):
+
+        pdf_link = link.find("a", {"title": "Download PDF"})
+        pdf_title = (title.text.split("Title: ")[1].split("Authors")[0])[:-3]
+        if pdf_link:
+            entries.append(
+                (pdf_link["href"].split("/pdf/")[-1], pdf_title, pdf_link["href"])
+            )
+    total = TOTAL_ENTRIES.search(page_soup.get_text())
+    return entries, int(total.group(1)) if total else None
+
+
+def iter_listing(get, base_url, year, month, show=500):
+    """
+    Pages through the whole cs listing of year/month, not only
+    the first `show` papers
+    """
+
+    year_str = str(year)[2] + str(year)[3]
+    skip = 0
+    while True:
+        page = get(f"{base_url}/list/cs/{year_str}{month:02}?skip={skip}&show={show}")
+        page.raise_for_status()
+        entries, total = parse_listing(page.text)
+        for arxiv_id, pdf_title, href in entries:
+            yield arxiv_id, pdf_title, base_url + "/" + href.lstrip("/")
+        skip += show
+        if total is not None and skip >= total:
+            break
+        if total is None and len(entries) < show:
+            break
+
+
+def iter_oai_records(get, base_url, from_date=None, until_date=None, set_spec="cs"):
+    """
+    Harvests the arXiv metadata of `set_spec` through OAI-PMH
+
+    from_date  : only records changed on or after this day (YYYY-MM-DD),
+                 this is what makes repeated harvests incremental
+    until_date : only records changed on or before this day
+
+    Yields (arxiv_id, title, pdf link, year, month) where year and
+    month come from the arXiv id, as in the monthly listings.
+    """
+
+    parameters = {"verb": "ListRecords", "metadataPrefix": "arXiv", "set": set_spec}
+    if from_date:
+        parameters["from"] = from_date
+    if until_date:
+        parameters["until"] = until_date
+
+    while True:
+        response = get(f"{base_url}/oai2", params=parameters)
+        if response.status_code == 503:
+            # OAI flow control, the server says when to come back
+            time.sleep(int(response.headers.get("Retry-After", 30)))
+            continue
+        response.raise_for_status()
+        root = Et.fromstring(response.content)
+
+        error = root.find(f"{OAI}error")
+        if error is not None:
+            if error.get("code") == "noRecordsMatch":
+                return
+            raise ValueError(f"OAI-PMH error {error.get('code')}: {error.text}")
+
+        for record in root.iter(f"{OAI}record"):
+            header = record.find(f"{OAI}header")
+            if header.get("status") == "deleted":
+                continue
+            metadata = record.find(f"{OAI}metadata/{ARXIV}arXiv")
+            arxiv_id = metadata.findtext(f"{ARXIV}id")
+            pdf_title = " ".join(metadata.findtext(f"{ARXIV}title").split())
+            year, month = id_to_date(arxiv_id)
+            yield arxiv_id, pdf_title, f"{base_url}/pdf/{arxiv_id}", year, month
+
+        token = root.find(f"{OAI}ListRecords/{OAI}resumptionToken")
+        if token is None or not (token.text or "").strip():
+            return
+        parameters = {"verb": "ListRecords", "resumptionToken": token.text.strip()}
@@ -2,83 +2,265 @@ import pandas as pd
 import numpy as np
 import gensim
 from gensim import corpora
+from gensim import utils
 from gensim.utils import simple_preprocess
+from gensim.matutils import MmWriter
 from gensim.corpora import Dictionary
 from gensim.models.callbacks import PerplexityMetric
 from gensim.test.utils import common_corpus, common_dictionary
 from gensim import corpora, models
 from gensim.test.utils import datapath
 from src.pyLDAvis_local import gensim_local
-from gensim.models import CoherenceModel
+import matplotlib
+# figures are only saved to files, never shown
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 from matplotlib import pylab as pl
 from wordcloud import WordCloud
 
-from smart_open import smart_open
 import os
+import csv
+import hashlib
+import pickle
+import catalog
 import itertools
+from scipy import sparse
+from multiprocessing import Pool
 import pyLDAvis.gensim
 
-# import pickle
 # import pyLDAvis.gensim
 
 
+def _sorted_listdir(path):
+    # numeric folders (years, months) in numeric order, hidden files skipped
+    names = [name for name in os.listdir(path) if not name.startswith(".")]
+    return sorted(names, key=lambda name: (not name.isdigit(), int(name) if name.isdigit() else 0, name))
+
+
+def list_documents(path):
+    """
+    (doc_id, year, month, filename) of every document in clean_data, in the fixed order
+    of the catalog. doc_id is "year/month/filename", the same for every run on the same data.
+    """
+    documents = catalog.get_documents(path)
+    return list(zip(documents.doc_id, documents.year.astype(str), documents.month.astype(str),
+                    documents.filename))
+
+
+def tokenize_file(filename):
+    """Tokens of a whole document, same as simple_preprocess of each of its lines"""
+    with open(filename) as f:
+        return simple_preprocess(f.read())
+
+
 class ReadFilesDir(object):
+    """One token list per file of a single folder"""
     def __init__(self, dirname):
         self.dirname = dirname
 
     def __iter__(self):
-        for filename in os.listdir(self.dirname):
-            for line in open(os.path.join(self.dirname, filename)):
-                yield simple_preprocess(line)
+        for filename in _sorted_listdir(self.dirname):
+            yield tokenize_file(os.path.join(self.dirname, filename))
 
 
 class ReadFilesDir2(object):
-    def __init__(self, dirname):
+    """
+    One token list per document of clean_data, in the order of list_documents,
+    so row i of a corpus built from it is the document self.doc_ids[i].
+
+    With processes set, documents are tokenized by a pool of worker processes
+    in shards of chunksize files, the order of the output stays the same.
+    """
+    def __init__(self, dirname, processes=None, chunksize=64):
         self.dirname = dirname
+        self.processes = processes
+        self.chunksize = chunksize
+        self.documents = list_documents(dirname)
+        self.doc_ids = [doc_id for doc_id, _, _, _ in self.documents]
+
+    def __len__(self):
+        return len(self.documents)
 
     def __iter__(self):
-        for year in os.listdir(self.dirname):
-            for month in os.listdir(os.path.join(self.dirname, year)):
-                for filename in os.listdir(os.path.join(self.dirname, year, month)):
-                    for line in open(os.path.join(self.dirname, year, month, filename)):
-                        yield simple_preprocess(line)
-                print(year + " " + month)
+        paths = [os.path.join(self.dirname, doc_id) for doc_id in self.doc_ids]
+        if not self.processes:
+            for doc_path in paths:
+                yield tokenize_file(doc_path)
+            return
+        with Pool(self.processes) as pool:
+            for tokens in pool.imap(tokenize_file, paths, chunksize=self.chunksize):
+                yield tokens
 
+    def iter_with_ids(self):
+        return zip(self.doc_ids, self)
 
-class BoWCorpus(object):
-    def __init__(self, path, dictionary):
-        self.filepath = path
-        self.dictionary = dictionary
 
-    def __iter__(self):
-        global mydict
-        for line in smart_open(self.filepath):
-            tokenized_list = simple_preprocess(line, deacc=True)
+def _dictionary_hash(dictionary):
+    """sha1 of the token ids of the dictionary"""
+    return hashlib.sha1(repr(sorted(dictionary.token2id.items())).encode()).hexdigest()
 
-            bow = self.dictionary.doc2bow(tokenized_list, allow_update=True)
 
-            mydict.merge_with(self.dictionary)
+def corpus_fingerprint(corpus, dictionary):
+    """
+    Short hash of the number of documents and non zero entries of the corpus and of
+    the dictionary (length and token ids). An MmCorpus gives its counts from the header
+    and the size and mtime of its file, any other corpus is read once and its content
+    hashed as well.
+    """
+    if hasattr(corpus, "num_docs") and hasattr(corpus, "num_nnz"):
+        content = f"{corpus.num_docs} {corpus.num_nnz}"
+        if isinstance(getattr(corpus, "input", None), str) and os.path.isfile(corpus.input):
+            stat = os.stat(corpus.input)
+            content += f" {stat.st_size} {stat.st_mtime_ns}"
+    else:
+        digest = hashlib.sha1()
+        num_docs, num_nnz = 0, 0
+        for bow in corpus:
+            num_docs += 1
+            num_nnz += len(bow)
+            digest.update(repr(list(bow)).encode())
+        content = f"{num_docs} {num_nnz} {digest.hexdigest()}"
+    content += f" {len(dictionary)} {_dictionary_hash(dictionary)}"
+    return hashlib.sha1(content.encode()).hexdigest()[:8]
 
-            yield bow
 
+class BoWCorpus(object):
+    """
+    Bag of words of a text file with one document per line, for a fixed dictionary:
+    words missing from it are skipped and the dictionary is never modified.
+
+    The byte offset of every line is indexed on the first pass, which gives len()
+    and corpus[i] without reading the whole file. With cache_fname the vectors are
+    written to a Matrix Market file (with its offsets index) during the first pass,
+    and every later pass, e.g. the 10 passes of an LDA model, reads them from there
+    instead of tokenizing the text again. The cache is only reused while its
+    fingerprint (cache_fname.fingerprint) matches the text file and the dictionary,
+    after filter_extremes or a change of the file it is built again.
+    """
+    def __init__(self, path, dictionary, cache_fname=None):
+        self.filepath = path
+        self.dictionary = dictionary
+        self.cache_fname = cache_fname
+        self.offsets = None
+        self.cache = None
+        if cache_fname and os.path.isfile(cache_fname + ".index") and self._cached_fingerprint() == self.fingerprint():
+            self.cache = corpora.MmCorpus(cache_fname)
+
+    def fingerprint(self):
+        """Size and mtime of the text file, length and sha1 of the token ids of the dictionary"""
+        stat = os.stat(self.filepath)
+        return f"{stat.st_size} {stat.st_mtime_ns} {len(self.dictionary)} {_dictionary_hash(self.dictionary)}"
+
+    def _cached_fingerprint(self):
+        try:
+            with open(self.cache_fname + ".fingerprint") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _bow(self, line):
+        return self.dictionary.doc2bow(simple_preprocess(line, deacc=True))
+
+    def _index(self):
+        offsets = []
+        offset = 0
+        with open(self.filepath, "rb") as f:
+            for line in f:
+                offsets.append(offset)
+                offset += len(line)
+        self.offsets = offsets
+
+    def _iter_text(self):
+        offsets = []
+        offset = 0
+        with open(self.filepath, "rb") as f:
+            for line in f:
+                offsets.append(offset)
+                offset += len(line)
+                yield self._bow(line)
+        self.offsets = offsets
+
+    def __len__(self):
+        if self.cache is not None:
+            return len(self.cache)
+        if self.offsets is None:
+            self._index()
+        return len(self.offsets)
+
+    def __getitem__(self, docno):
+        if self.cache is not None:
+            return self.cache[docno]
+        if self.offsets is None:
+            self._index()
+        with open(self.filepath, "rb") as f:
+            f.seek(self.offsets[docno])
+            return self._bow(f.readline())
 
-def create_dictionary(path):
-    dictionary = Dictionary()
-    for year in os.listdir(path):
-        for month in os.listdir(os.path.join(path, year)):
-            dict_temp = corpora.Dictionary(ReadFilesDir(os.path.join(path, year, month)))
-            dictionary.merge_with(dict_temp)
-            print(month)
-    return dictionary
+    def __iter__(self):
+        if self.cache is None and self.cache_fname:
+            # written under a temporary name, an interrupted pass leaves no cache behind
+            tmp_fname = self.cache_fname + ".tmp"
+            fingerprint = self.fingerprint()
+            write_mm_corpus(tmp_fname, self._iter_text(), self.dictionary)
+            with open(tmp_fname + ".fingerprint", "w") as f:
+                f.write(fingerprint)
+            os.replace(tmp_fname, self.cache_fname)
+            os.replace(tmp_fname + ".index", self.cache_fname + ".index")
+            os.replace(tmp_fname + ".fingerprint", self.cache_fname + ".fingerprint")
+            self.cache = corpora.MmCorpus(self.cache_fname)
+        if self.cache is not None:
+            for bow in self.cache:
+                yield bow
+        else:
+            for bow in self._iter_text():
+                yield bow
+
+
+def write_mm_corpus(fname, corpus, dictionary):
+    """
+    Stream bag of words vectors into a Matrix Market file.
 
+    Rows are written as they come and the header is filled in at the end,
+    the same way MmCorpus.serialize does it, together with the fname.index
+    offsets that let MmCorpus access documents at random.
+    The number of terms is read from the dictionary after the last row,
+    so the dictionary may still grow while the corpus is consumed.
+    """
+    writer = MmWriter(fname)
+    writer.write_headers(-1, -1, -1)
+    offsets = []
+    poslast = -1
+    num_docs, num_nnz = 0, 0
+    for docno, bow in enumerate(corpus):
+        posnow = writer.fout.tell()
+        if posnow == poslast:
+            offsets[-1] = -1
+        offsets.append(posnow)
+        poslast = posnow
+        _, veclen = writer.write_vector(docno, bow)
+        num_docs += 1
+        num_nnz += veclen
+    writer.fake_headers(num_docs, len(dictionary), num_nnz)
+    writer.close()
+    utils.pickle(offsets, fname + ".index")
+
+
+def build_dictionary_and_corpus(path, dictionary_fname="dictionary_all_docs", corpus_fname="corpus_all_docs",
+                                processes=None):
+    """
+    Build the dictionary and the corpus in a single pass over clean_data.
 
-def create_corpus(dict, path):
-    gensim_corpus = [dict.doc2bow(token, allow_update=True) for token in
-                     ReadFilesDir2(path)]
-    # Save the corpus
-    corpora.MmCorpus.serialize("corpus_all_docs", gensim_corpus)
-    return gensim_corpus
+    Every document is tokenized once, the dictionary is updated with it and its
+    bag of words goes straight to the Matrix Market file, so memory holds one
+    document and the dictionary instead of the whole corpus.
+    Row i of the corpus is document i of list_documents(path), with processes
+    set the documents are tokenized in parallel.
+    """
+    dictionary = Dictionary()
+    bows = (dictionary.doc2bow(tokens, allow_update=True) for tokens in ReadFilesDir2(path, processes))
+    write_mm_corpus(corpus_fname, bows, dictionary)
+    dictionary.save(dictionary_fname)
+    return dictionary, corpora.MmCorpus(corpus_fname)
 
 
 def build_lda_model(corpus: list, dictionary: gensim.corpora.dictionary.Dictionary, NUM_TOPICS: int):
@@ -93,7 +275,258 @@ def build_lda_model(corpus: list, dictionary: gensim.corpora.dictionary.Dictiona
     return lda_model
 
 
-def compute_coherence_values(dictionary, corpus, limit, start=2, step=3):
+def save_model_version(lda, dictionary, months, model_dir="models"):
+    """
+    Save the model and its dictionary as the next version in model_dir.
+    models/versions.csv records, for every version, the year/month folders it was trained on
+    in addition to the previous version, the first version records every month of the
+    initial training.
+    Returns the number of the saved version.
+    """
+    os.makedirs(model_dir, exist_ok=True)
+    versions_fname = os.path.join(model_dir, "versions.csv")
+    versions = pd.read_csv(versions_fname) if os.path.isfile(versions_fname) else None
+    version = 1 if versions is None else int(versions.version.max()) + 1
+    lda.save(os.path.join(model_dir, f"lda_v{version}"))
+    dictionary.save(os.path.join(model_dir, f"dictionary_v{version}"))
+    row = pd.DataFrame({"version": [version],
+                        "months": [";".join(f"{year}/{month}" for year, month in months)],
+                        "num_terms": [len(dictionary)],
+                        "saved": [pd.Timestamp.now().isoformat()]})
+    row.to_csv(versions_fname, mode="a", header=versions is None, index=False)
+    return version
+
+
+def load_model_version(model_dir="models", version=None):
+    """
+    The model and dictionary of the given version, the latest one by default.
+    Returns (lda, dictionary, version).
+    """
+    versions = pd.read_csv(os.path.join(model_dir, "versions.csv"))
+    version = int(versions.version.max()) if version is None else version
+    lda = models.LdaModel.load(os.path.join(model_dir, f"lda_v{version}"))
+    dictionary = Dictionary.load(os.path.join(model_dir, f"dictionary_v{version}"))
+    return lda, dictionary, version
+
+
+def new_months(path, model_dir="models"):
+    """Year/month folders of clean_data that no saved model version was trained on"""
+    versions = pd.read_csv(os.path.join(model_dir, "versions.csv"))
+    trained = set(month for months in versions.months.dropna() for month in months.split(";"))
+    documents = catalog.get_documents(path)
+    months = documents[["year", "month"]].drop_duplicates()
+    return [(year, month) for year, month in months.itertuples(index=False)
+            if f"{year}/{month}" not in trained]
+
+
+def _extend_dictionary(dictionary, texts, no_below, max_new_terms):
+    """
+    Add to the dictionary the words of texts that it does not know yet, appear in
+    at least no_below of the texts, at most max_new_terms of them, most frequent first.
+    The texts are then counted in the document statistics (dfs, cfs, num_docs, num_pos,
+    num_nnz) the same way add_documents does, so filter_extremes stays consistent.
+    """
+    new_dfs = {}
+    new_cfs = {}
+    for tokens in texts:
+        for token in tokens:
+            if token not in dictionary.token2id:
+                new_cfs[token] = new_cfs.get(token, 0) + 1
+        for token in set(tokens):
+            if token not in dictionary.token2id:
+                new_dfs[token] = new_dfs.get(token, 0) + 1
+    candidates = sorted((token for token, df in new_dfs.items() if df >= no_below),
+                        key=lambda token: (-new_dfs[token], token))[:max_new_terms]
+    for token in candidates:
+        token_id = len(dictionary.token2id)
+        dictionary.token2id[token] = token_id
+    for tokens in texts:
+        counts = {}
+        for token in tokens:
+            token_id = dictionary.token2id.get(token)
+            if token_id is not None:
+                counts[token_id] = counts.get(token_id, 0) + 1
+        for token_id, count in counts.items():
+            dictionary.dfs[token_id] = dictionary.dfs.get(token_id, 0) + 1
+            if hasattr(dictionary, "cfs"):
+                dictionary.cfs[token_id] = dictionary.cfs.get(token_id, 0) + count
+        dictionary.num_docs += 1
+        dictionary.num_pos += len(tokens)
+        dictionary.num_nnz += len(counts)
+    dictionary.id2token = {}
+    return len(candidates)
+
+
+def _grow_model(lda, num_terms):
+    """Add topic-word columns for new dictionary ids, the new words start from the prior eta"""
+    extra = num_terms - lda.num_terms
+    if extra <= 0:
+        return
+    if lda.eta.ndim == 1:
+        lda.eta = np.concatenate([lda.eta, np.full(extra, lda.eta.mean(), dtype=lda.eta.dtype)])
+    else:
+        lda.eta = np.hstack([lda.eta, np.repeat(lda.eta.mean(axis=1, keepdims=True), extra, axis=1)])
+    lda.state.eta = lda.eta
+    lda.state.sstats = np.hstack([lda.state.sstats,
+                                  np.zeros((lda.num_topics, extra), dtype=lda.state.sstats.dtype)])
+    lda.num_terms = num_terms
+    lda.sync_state()
+
+
+def update_lda_model(path, months=None, model_dir="models", policy="freeze", no_below=5,
+                     max_new_terms=10000, chunksize=2000):
+    """
+    Update the latest model version with the documents of new year/month folders only
+    and save the result as a new version, the cost depends on the new data, not on the archive.
+
+    Parameters:
+    ----------
+    path : path to clean_data folder
+    months : [(year, month)] to add, by default every folder no version was trained on
+    policy : "freeze" ignores words the dictionary does not know,
+             "extend" adds new words found in at least no_below new documents,
+             at most max_new_terms of them
+    chunksize : documents per LdaModel.update step
+
+    Returns:
+    -------
+    lda, dictionary, version
+    """
+    lda, dictionary, _ = load_model_version(model_dir)
+    months = new_months(path, model_dir) if months is None else months
+    if not months:
+        return lda, dictionary, None
+    documents = catalog.get_documents(path)
+    wanted = set((int(year), int(month)) for year, month in months)
+    paths = [doc_path for year, month, doc_path in zip(documents.year, documents.month, documents.path)
+             if (year, month) in wanted]
+    texts = [tokenize_file(doc_path) for doc_path in paths]
+
+    if policy == "extend" and _extend_dictionary(dictionary, texts, no_below, max_new_terms):
+        _grow_model(lda, len(dictionary))
+        lda.id2word = dictionary
+    elif policy not in ("freeze", "extend"):
+        raise ValueError(f"Unknown policy {policy}")
+
+    # the model may have been trained and saved as LdaMulticore, whose update() has no chunksize
+    models.LdaModel.update(lda, [dictionary.doc2bow(tokens) for tokens in texts], chunksize=chunksize)
+    version = save_model_version(lda, dictionary, sorted(wanted), model_dir)
+    return lda, dictionary, version
+
+
+def document_occurrence(corpus, num_terms, fname):
+    """
+    Binary term x document matrix of the corpus saved to fname (.npz).
+    The u_mass coherence of any topic only needs the document counts of its
+    top words and of their pairs, which are read from this matrix, so the
+    corpus is read once for a whole sweep instead of once per model.
+    """
+    occurrence = gensim.matutils.corpus2csc(corpus, num_terms=num_terms, dtype=np.int32).tocsr()
+    occurrence.data[:] = 1
+    sparse.save_npz(fname, occurrence)
+
+
+def u_mass_coherence(occurrence, topics, topn=20):
+    """
+    u_mass coherence of topic-term distributions, same as
+    CoherenceModel(coherence='u_mass', topn=topn).get_coherence()
+
+    Parameters:
+    ----------
+    occurrence : term x document matrix from document_occurrence
+    topics : topic-term matrix, e.g. model.get_topics()
+    """
+    num_docs = occurrence.shape[1]
+    topic_coherences = []
+    for topic in topics:
+        top_ids = gensim.matutils.argsort(topic, topn=topn, reverse=True)
+        rows = occurrence[top_ids]
+        co_occurrence = (rows @ rows.T).toarray()
+        counts = np.diag(co_occurrence)
+        # every word against all the words ranked above it
+        w_prime, w_star = np.tril_indices(len(top_ids), -1)
+        m_lc = np.log((co_occurrence[w_prime, w_star] / num_docs + 1e-12) / (counts[w_star] / num_docs))
+        topic_coherences.append(m_lc.mean())
+    return float(np.mean(topic_coherences))
+
+
+_sweep = {}
+
+
+def _init_sweep(dictionary, corpus, occurrence_fname):
+    _sweep["dictionary"] = dictionary
+    _sweep["corpus"] = corpus
+    _sweep["occurrence"] = sparse.load_npz(occurrence_fname)
+
+
+def _run_trial(trial):
+    key, num_topics, alpha, eta, model_fname, lda_kwargs = trial
+    model = models.LdaModel(_sweep["corpus"], id2word=_sweep["dictionary"], num_topics=num_topics,
+                            alpha=alpha, eta=eta, **lda_kwargs)
+    model.save(model_fname)
+    coherence = u_mass_coherence(_sweep["occurrence"], model.get_topics())
+    return key, num_topics, alpha, eta, coherence, model_fname
+
+
+def run_sweep(dictionary, corpus, topic_counts, alphas=("symmetric",), etas=(None,), output_dir="sweep",
+              cpu_budget=max(1, os.cpu_count() - 1), **lda_kwargs):
+    """
+    Train an LDA model for every combination of topic count, alpha and eta and score it
+    with u_mass coherence.
+
+    Trials run concurrently, one single core LdaModel per process, at most cpu_budget at a time.
+    Every model is saved to output_dir as soon as it is trained and only its score is kept,
+    in output_dir/scores.csv. Trials found there are skipped, so an interrupted sweep
+    continues where it stopped. The co-occurrence matrix, trial keys and model files are named
+    after corpus_fingerprint(corpus, dictionary), trial keys and model files also after a hash
+    of lda_kwargs, so a sweep of another corpus, dictionary or lda_kwargs in the same
+    output_dir trains and scores its own models.
+
+    Parameters:
+    ----------
+    dictionary : Gensim dictionary
+    corpus : Gensim corpus, preferably a streamed MmCorpus (it is sent once to every process)
+    topic_counts : numbers of topics to try
+    alphas, etas : priors to try, as accepted by LdaModel
+    lda_kwargs : passed to every LdaModel, e.g. passes or chunksize
+
+    Returns:
+    -------
+    scores : DataFrame with key, num_topics, alpha, eta, coherence, model_file, in trial order
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    scores_fname = os.path.join(output_dir, "scores.csv")
+    data_hash = corpus_fingerprint(corpus, dictionary)
+    occurrence_fname = os.path.join(output_dir, f"occurrence_{data_hash}.npz")
+    if not os.path.isfile(occurrence_fname):
+        document_occurrence(corpus, len(dictionary), occurrence_fname)
+
+    kwargs_hash = hashlib.sha1(repr(sorted(lda_kwargs.items())).encode()).hexdigest()[:8]
+    trials = [(f"topics{num_topics}_alpha{alpha}_eta{eta}_{data_hash}_{kwargs_hash}", num_topics, alpha, eta,
+               os.path.join(output_dir, f"lda_topics{num_topics}_alpha{alpha}_eta{eta}_{data_hash}_{kwargs_hash}"),
+               lda_kwargs)
+              for num_topics, alpha, eta in itertools.product(topic_counts, alphas, etas)]
+    done = set(pd.read_csv(scores_fname).key) if os.path.isfile(scores_fname) else set()
+    todo = [trial for trial in trials if trial[0] not in done]
+
+    if todo:
+        write_header = not os.path.isfile(scores_fname)
+        with Pool(min(cpu_budget, len(todo)), initializer=_init_sweep,
+                  initargs=(dictionary, corpus, occurrence_fname)) as pool, open(scores_fname, "a", newline="") as f:
+            writer = csv.writer(f)
+            if write_header:
+                writer.writerow(["key", "num_topics", "alpha", "eta", "coherence", "model_file"])
+            for row in pool.imap_unordered(_run_trial, todo):
+                writer.writerow(row)
+                f.flush()
+                print(row[0], row[4])
+
+    scores = pd.read_csv(scores_fname).drop_duplicates("key", keep="last").set_index("key")
+    return scores.loc[[trial[0] for trial in trials]].reset_index()
+
+
+def compute_coherence_values(dictionary, corpus, limit, start=2, step=3, output_dir="sweep",
+                             cpu_budget=max(1, os.cpu_count() - 1)):
     """
     Compute u_mass coherence for various number of topics
 
@@ -101,130 +534,318 @@ def compute_coherence_values(dictionary, corpus, limit, start=2, step=3):
     ----------
     dictionary : Gensim dictionary
     corpus : Gensim corpus
-    texts : List of input texts
     limit : Max num of topics
+    output_dir : folder the models and scores are saved to, see run_sweep
+    cpu_budget : number of models trained at the same time
 
     Returns:
     -------
-    model_list : List of LDA topic models
+    model_files : Files of the LDA topic models, load them with LdaModel.load
     coherence_values : Coherence values corresponding to the LDA model with respective number of topics
     """
-    coherence_values = []
-    model_list = []
-    for num_topics in range(start, limit, step):
-        model = models.LdaMulticore(gensim_corpus, id2word=dictionary, num_topics=num_topics, workers=2)
-        model_list.append(model)
-        coherencemodel = CoherenceModel(model=model, corpus=corpus, dictionary=dictionary, coherence='u_mass')
-        coherence_values.append(coherencemodel.get_coherence())
-
-    return model_list, coherence_values
-
-
-def format_topics_sentences(ldamodel, corpus: list):
-    sent_topics_df = pd.DataFrame()
-
-    # Get main topic in each document
-    for i, row in enumerate(ldamodel[corpus]):
-        row = sorted(row, key=lambda x: (x[1]), reverse=True)
-        # Get the Dominant topic, Perc Contribution and Keywords for each document
-        for j, (topic_num, prop_topic) in enumerate(row):
-            if j == 0:
-                wp = ldamodel.show_topic(topic_num)
-                topic_keywords = ", ".join([word for word, prop in wp])
-                sent_topics_df = sent_topics_df.append(pd.Series([int(topic_num),
-                                                                  round(prop_topic, 4),
-                                                                  topic_keywords]),
-                                                       ignore_index=True)
-            else:
-                break
+    scores = run_sweep(dictionary, corpus, range(start, limit, step), output_dir=output_dir, cpu_budget=cpu_budget)
+    return list(scores.model_file), list(scores.coherence)
+
+
+def format_topics_sentences(ldamodel, corpus: list, chunksize: int = 2000):
+    """
+    Dominant topic, its contribution and the topic keywords of every document.
+
+    Documents are inferred chunksize at a time into a doc-topic matrix, the dominant
+    topic is its argmax and the keywords come from a table computed once per topic,
+    so the running time is linear in the number of documents.
+    """
+    topic_keywords = np.array([", ".join([word for word, prop in ldamodel.show_topic(topic_num)])
+                               for topic_num in range(ldamodel.num_topics)], dtype=object)
+    dominant_topics = []
+    contributions = []
+    for i, chunk in enumerate(utils.grouper(corpus, chunksize)):
+        gamma, _ = ldamodel.inference(chunk)
+        doc_topics = gamma / gamma.sum(axis=1)[:, np.newaxis]
+        dominant_topics.append(doc_topics.argmax(axis=1))
+        contributions.append(doc_topics.max(axis=1))
         # Show the progress
-        if i % 100 == 0:
-            print(i)
-    sent_topics_df.columns = ['Dominant_Topic', 'Frac_Contribution', 'Topic_Keywords']
-    return sent_topics_df
+        print((i + 1) * chunksize)
+    dominant_topics = np.concatenate(dominant_topics) if dominant_topics else np.array([], dtype=int)
+    contributions = np.concatenate(contributions) if contributions else np.array([])
+    return pd.DataFrame({'Dominant_Topic': dominant_topics,
+                         'Frac_Contribution': contributions.round(4),
+                         'Topic_Keywords': topic_keywords[dominant_topics]})
 
 
 def get_doc_names(path):
-    doc_names = []
-    years = []
-    months = []
-    for year in os.listdir(path):
-        for month in os.listdir(os.path.join(path, year)):
-            for filename in os.listdir(os.path.join(path, year, month)):
-                doc_names.append(filename)
-                years.append(year)
-                months.append(month)
+    """Names, years and months of the documents in the order of the corpus rows"""
+    documents = list_documents(path)
+    doc_names = [filename for _, _, _, filename in documents]
+    years = [year for _, year, _, _ in documents]
+    months = [month for _, _, month, _ in documents]
     return doc_names, years, months
 
 
+PERIODS_PER_YEAR = {"month": 12, "quarter": 4, "year": 1}
+
+
+def _period_codes(doc_df: pd.DataFrame, freq: str):
+    """Consecutive integer code of the period of every document"""
+    per_year = PERIODS_PER_YEAR[freq]
+    years = doc_df.Year.astype(int).to_numpy()
+    months = doc_df.Month.astype(int).to_numpy()
+    return years * per_year + (months - 1) * per_year // 12
+
+
+def _period_index(first: int, num_periods: int, freq: str):
+    """First day of the periods with codes first, first + 1, ..."""
+    per_year = PERIODS_PER_YEAR[freq]
+    period_codes = np.arange(first, first + num_periods)
+    return pd.DatetimeIndex(pd.to_datetime(pd.DataFrame({"year": period_codes // per_year,
+                                                         "month": period_codes % per_year * 12 // per_year + 1,
+                                                         "day": 1})))
+
+
+def topic_counts(doc_df: pd.DataFrame, num_topics: int, freq: str = "month", cache_dir: str = None):
+    """
+    Number of documents of every dominant topic in every period, as a dense
+    (period x topic) array built in one bincount.
+
+    Parameters:
+    ----------
+    doc_df : frame with Year, Month and Dominant_Topic columns
+    num_topics : number of topics of the model
+    freq : "month", "quarter" or "year"
+    cache_dir : if given, results are saved there as .npz, keyed by a hash of the
+                input, and read back on the next call with the same input
+
+    Returns:
+    -------
+    periods : DatetimeIndex with the first day of every period, with no gaps
+    counts : int array of shape (len(periods), num_topics)
+    """
+    codes = _period_codes(doc_df, freq)
+    topics = doc_df.Dominant_Topic.astype(int).to_numpy()
+
+    cache_fname = None
+    if cache_dir:
+        digest = hashlib.sha1()
+        for array in (codes, topics):
+            digest.update(np.ascontiguousarray(array, dtype=np.int64).tobytes())
+        digest.update(f"{freq}{num_topics}".encode())
+        cache_fname = os.path.join(cache_dir, f"topic_counts_{freq}_{digest.hexdigest()}.npz")
+        if os.path.isfile(cache_fname):
+            cached = np.load(cache_fname)
+            return pd.DatetimeIndex(cached["periods"]), cached["counts"]
+
+    first = codes.min() if len(codes) else 0
+    num_periods = codes.max() - first + 1 if len(codes) else 0
+    counts = np.bincount((codes - first) * num_topics + topics,
+                         minlength=num_periods * num_topics).reshape(num_periods, num_topics)
+    periods = _period_index(first, num_periods, freq)
+
+    if cache_fname:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(cache_fname, periods=periods.values, counts=counts)
+    return periods, counts
+
+
+def write_doc_topics(ldamodel, corpus, fname: str, chunksize: int = 2000):
+    """
+    Infer the topic distribution of every document and store the doc-topic matrix
+    as a float32 .npy file, filled chunksize documents at a time through a memory map,
+    so the whole matrix is never held in memory.
+
+    Parameters:
+    ----------
+    ldamodel : trained model
+    corpus : bag of words corpus supporting len(), rows in the order of list_documents
+    fname : .npy file to write
+
+    Returns:
+    -------
+    read only memory map of shape (len(corpus), num_topics)
+    """
+    tmp_fname = fname + ".part"
+    doc_topics = np.lib.format.open_memmap(tmp_fname, mode="w+", dtype=np.float32,
+                                           shape=(len(corpus), ldamodel.num_topics))
+    start = 0
+    for chunk in utils.grouper(corpus, chunksize):
+        gamma, _ = ldamodel.inference(chunk)
+        doc_topics[start:start + len(chunk)] = gamma / gamma.sum(axis=1)[:, np.newaxis]
+        start += len(chunk)
+        # Show the progress
+        print(start)
+    doc_topics.flush()
+    del doc_topics
+    os.replace(tmp_fname, fname)
+    return load_doc_topics(fname)
+
+
+def load_doc_topics(fname: str):
+    """Doc-topic matrix written by write_doc_topics, memory mapped read only"""
+    return np.load(fname, mmap_mode="r")
+
+
+def topic_shares(doc_topics: np.ndarray, doc_df: pd.DataFrame, freq: str = "month", chunksize: int = 100000):
+    """
+    Mean share of every topic in the documents of every period, a weighted
+    alternative to topic_counts which counts only the dominant topic.
+
+    Parameters:
+    ----------
+    doc_topics : (document x topic) matrix, e.g. from load_doc_topics
+    doc_df : frame with Year and Month columns, one row per row of doc_topics
+    freq : "month", "quarter" or "year"
+    chunksize : rows of doc_topics read from disk at a time
+
+    Returns:
+    -------
+    periods : DatetimeIndex with the first day of every period, with no gaps
+    shares : float array of shape (len(periods), num_topics), rows of periods
+             without documents are 0
+    """
+    codes = _period_codes(doc_df, freq)
+    first = codes.min() if len(codes) else 0
+    num_periods = codes.max() - first + 1 if len(codes) else 0
+    codes = codes - first
+    sums = np.zeros((num_periods, doc_topics.shape[1]))
+    for start in range(0, len(codes), chunksize):
+        np.add.at(sums, codes[start:start + chunksize], doc_topics[start:start + chunksize])
+    num_docs = np.bincount(codes, minlength=num_periods)
+    shares = sums / np.maximum(num_docs, 1)[:, np.newaxis]
+    return _period_index(first, num_periods, freq), shares
+
+
+def counts_to_frame(periods: pd.DatetimeIndex, counts: np.ndarray):
+    """Wide (period x topic) table of topic_counts, e.g. for to_html"""
+    frame = pd.DataFrame(counts, index=periods)
+    frame.index.name = "Date"
+    frame.columns.name = "Dominant_Topic"
+    return frame
+
+
+def _counts_to_long(periods: pd.DatetimeIndex, counts: np.ndarray):
+    rows, topics = np.nonzero(counts)
+    return pd.DataFrame({"Dominant_Topic": topics,
+                         "counts": counts[rows, topics],
+                         "Date": periods[rows]})
+
+
 def topics_by_time(doc_df: pd.DataFrame):
-    topics_time = (doc_df
-                   .groupby(by=["Year", "Month", "Dominant_Topic"])
-                   .size()
-                   .reset_index(name='counts'))
-    topics_time[["Year", "Month", "Dominant_Topic"]] = (topics_time[["Year",
-                                                                    "Month",
-                                                                    "Dominant_Topic"]]
-                                                        .astype(int))
-    topics_time['Date'] = pd.to_datetime(topics_time[['Year', 'Month']].assign(DAY=1))
-    topics_time = topics_time.sort_values(by=["Year", "Month"])
-    topics_time = topics_time.drop(["Year", "Month"], axis=1)
-    return topics_time
+    """Long (Dominant_Topic, counts, Date) frame of the monthly topic counts"""
+    num_topics = int(doc_df.Dominant_Topic.astype(int).max()) + 1
+    return _counts_to_long(*topic_counts(doc_df, num_topics, "month"))
 
 
 def topics_by_time2(doc_df: pd.DataFrame):
-    topics_time = (doc_df
-                   .groupby(by=["Year", "Dominant_Topic"])
-                   .size()
-                   .reset_index(name='counts'))
-    topics_time[["Year", "Dominant_Topic"]] = (topics_time[["Year", "Dominant_Topic"]].astype(int))
-    topics_time['Date'] = pd.to_datetime(topics_time[['Year']].assign(DAY=1, MONTH=1))
-    topics_time = topics_time.sort_values(by=["Year"])
-    topics_time = topics_time.drop(["Year"], axis=1)
-    return topics_time
-
-
-def plot_topics_over_time(topics: pd.DataFrame, num_topics: int):
-    colors = ["darkblue", "chartreuse", "fuchsia", "red", "lime"]
-    for i in range(5):
-        for j in range(5*i, 5*(i+1), 1):
-            data = topics[topics.Dominant_Topic == j]
-            plt.plot(data.Date, data.counts, color=colors[j % 5])
-        plt.title("Documents in Topics over Time")
-        plt.xlabel("Time")
-        plt.ylabel("Number of Documents in Topics")
-        plt.legend(range(5*i, 5*(i+1), 1), loc="best")
-        plt.savefig(f"Topics{5*i}-{5*(i+1)-1}")
-        plt.close()
-
-
-def plot_topics_over_years(topics: pd.DataFrame):
+    """Long (Dominant_Topic, counts, Date) frame of the yearly topic counts"""
+    num_topics = int(doc_df.Dominant_Topic.astype(int).max()) + 1
+    return _counts_to_long(*topic_counts(doc_df, num_topics, "year"))
+
+
+def _figure_hash(render, args):
+    return hashlib.sha1(pickle.dumps((render.__name__, args), protocol=4)).hexdigest()
+
+
+def _render(job):
+    fname, render, args = job
+    fig = render(*args)
+    try:
+        fig.savefig(fname)
+    finally:
+        plt.close(fig)
+    return fname
+
+
+def render_figures(jobs, processes=None, hashes_fname="figures.csv"):
+    """
+    Render and save figures in a pool of worker processes.
+
+    Parameters:
+    ----------
+    jobs : list of (fname, render, args), render(*args) returns a matplotlib figure,
+           it has to be a module level function and args must be picklable
+    processes : number of worker processes, all cores by default
+    hashes_fname : csv with the hash of the inputs of every saved figure, a figure
+                   whose file exists and whose inputs did not change is not rendered again
+
+    Returns:
+    -------
+    file names of the figures rendered in this call
+    """
+    hashes = {}
+    if os.path.isfile(hashes_fname):
+        with open(hashes_fname, newline="") as f:
+            hashes = {fname: digest for fname, digest in csv.reader(f)}
+    pending = []
+    for fname, render, args in jobs:
+        digest = _figure_hash(render, args)
+        if hashes.get(fname) != digest or not os.path.isfile(fname):
+            pending.append((fname, render, args))
+            hashes[fname] = digest
+    if not pending:
+        return []
+    if processes == 1 or len(pending) == 1:
+        rendered = [_render(job) for job in pending]
+    else:
+        with Pool(processes) as pool:
+            rendered = list(pool.imap_unordered(_render, pending))
+    with open(hashes_fname, "w", newline="") as f:
+        csv.writer(f).writerows(sorted(hashes.items()))
+    return rendered
+
+
+def _topic_lines_figure(x, ys, topics):
     colors = ["darkblue", "chartreuse", "fuchsia", "red", "lime"]
-    for i in range(5):
-        for j in range(5 * i, 5 * (i + 1), 1):
-            data = topics[topics.Dominant_Topic == j]
-            plt.plot([str(date.year) for date in data.Date], data.counts, color=colors[j % 5])
-        plt.title("Documents in Topics over Time")
-        plt.xlabel("Time")
-        plt.ylabel("Number of Documents in Topics")
-        plt.legend(range(5 * i, 5 * (i + 1), 1), loc="best")
-        plt.savefig(f"Topics_years_{5 * i}-{5 * (i + 1) - 1}")
-        plt.close()
-
-
-def create_word_clouds(lda_model):
-    for t in range(lda_model.num_topics):
-        plt.figure()
-        plt.imshow(WordCloud(background_color="white").fit_words(dict(lda_model.show_topic(t, 200))))
-        plt.axis("off")
-        plt.title("Topic #" + str(t))
-        plt.savefig(f"Topic_{t}_WordCloud")
+    fig, ax = plt.subplots()
+    for y, topic in zip(ys, topics):
+        ax.plot(x, y, color=colors[topic % 5])
+    ax.set_title("Documents in Topics over Time")
+    ax.set_xlabel("Time")
+    ax.set_ylabel("Number of Documents in Topics")
+    ax.legend(topics, loc="best")
+    return fig
+
+
+def _word_cloud_figure(topic, frequencies):
+    fig, ax = plt.subplots()
+    ax.imshow(WordCloud(background_color="white").fit_words(frequencies))
+    ax.axis("off")
+    ax.set_title("Topic #" + str(topic))
+    return fig
+
+
+def _topic_lines_jobs(x, counts, prefix):
+    jobs = []
+    for i in range(0, counts.shape[1], 5):
+        topics = list(range(i, min(i + 5, counts.shape[1])))
+        ys = [np.asarray(counts[:, j]) for j in topics]
+        jobs.append((f"{prefix}{topics[0]}-{topics[-1]}.png", _topic_lines_figure, (x, ys, topics)))
+    return jobs
+
+
+def plot_topics_over_time(periods: pd.DatetimeIndex, counts: np.ndarray, processes=None):
+    """One figure per 5 topics, Topics0-4.png, Topics5-9.png, ..."""
+    return render_figures(_topic_lines_jobs(periods.to_pydatetime(), counts, "Topics"), processes)
+
+
+def plot_topics_over_years(periods: pd.DatetimeIndex, counts: np.ndarray, processes=None):
+    """One figure per 5 topics, Topics_years_0-4.png, Topics_years_5-9.png, ..."""
+    return render_figures(_topic_lines_jobs([str(date.year) for date in periods], counts, "Topics_years_"),
+                          processes)
+
+
+def create_word_clouds(lda_model, processes=None):
+    """One word cloud of the 200 top words per topic, Topic_0_WordCloud.png, ..."""
+    jobs = [(f"Topic_{t}_WordCloud.png", _word_cloud_figure, (t, dict(lda_model.show_topic(t, 200))))
+            for t in range(lda_model.num_topics)]
+    return render_figures(jobs, processes)
 
 
 if __name__ == "__main__":
     print("Loading path...")
     path = os.path.join(os.path.dirname(os.getcwd()), "clean_data")
 
+    # Build the dictionary and the corpus for the first time (one pass over clean_data)
+    # dictionary, gensim_corpus = build_dictionary_and_corpus(path)
+
     print("Loading dictionary...")
     dictionary = Dictionary()
     dictionary = dictionary.load("dictionary_all_docs")
@@ -246,6 +867,12 @@ if __name__ == "__main__":
     print("Loading model...")
     lda = models.LdaMulticore.load("model_multicore_25topics")
 
+    # Register the loaded model as the first version, with every month it was trained on ...
+    # save_model_version(lda, dictionary,
+    #                    catalog.get_documents(path)[["year", "month"]].drop_duplicates().values.tolist())
+    # ... and after scraping new months, update it with the new folders only
+    # lda, dictionary, version = update_lda_model(path, policy="extend")
+
     # Print out the topics
     topics = lda.print_topics(num_words=5, num_topics=-1)
     for topic in topics:
@@ -267,15 +894,15 @@ if __name__ == "__main__":
 
     # # Using coherence model to optimize LDA model by number of topics
     # # Starting from 5 to 40 topics by 5 topics
-    # model_list, coherence_values = compute_coherence_values(dictionary=dictionary,
-    #                                                         corpus=gensim_corpus,
-    #                                                         start=5,
-    #                                                         limit=40,
-    #                                                         step=5)
+    # model_files, coherence_values = compute_coherence_values(dictionary=dictionary,
+    #                                                          corpus=gensim_corpus,
+    #                                                          start=5,
+    #                                                          limit=40,
+    #                                                          step=5)
     # max_value = max(coherence_values)
     # max_index = coherence_values.index(max_value)
     #
-    # best_model = model_list[max_index]
+    # best_model = models.LdaModel.load(model_files[max_index])
     # best_model.save("best_coherence_2_50_5")
 
     # # Show the graph of relationship between the number of topics and u_mass coherence
@@ -323,14 +950,26 @@ if __name__ == "__main__":
     #########################################################################
 
     # Show how the number of documents for specific topic changes by months
-    topics_count = topics_by_time(df_dominant_topic[df_dominant_topic.Year != "2020"])
-    topics_count.to_html("topics_count_over_time.html")
-    plot_topics_over_time(topics_count, 25)
+    periods, counts = topic_counts(df_dominant_topic[df_dominant_topic.Year != "2020"], lda.num_topics,
+                                   "month", cache_dir="topic_counts")
+    counts_to_frame(periods, counts).to_html("topics_count_over_time.html")
+    plot_topics_over_time(periods, counts)
 
     # Show how the number of documents for specific topic changes by years
-    topics_count2 = topics_by_time2(df_dominant_topic[df_dominant_topic.Year != "2020"])
-    topics_count2.to_html("topics_count_over_years.html")
-    plot_topics_over_years(topics_count2)
+    periods, counts = topic_counts(df_dominant_topic[df_dominant_topic.Year != "2020"], lda.num_topics,
+                                   "year", cache_dir="topic_counts")
+    counts_to_frame(periods, counts).to_html("topics_count_over_years.html")
+    plot_topics_over_years(periods, counts)
+
+    # Weighted version: mean topic share of the documents in every month, from the full
+    # doc-topic matrix (inferred once, then memory mapped from doc_topics_25.npy)
+    if os.path.isfile("doc_topics_25.npy"):
+        doc_topics = load_doc_topics("doc_topics_25.npy")
+    else:
+        doc_topics = write_doc_topics(lda, gensim_corpus, "doc_topics_25.npy")
+    periods, shares = topic_shares(doc_topics, df_dominant_topic, "month")
+    in_range = periods.year != 2020
+    counts_to_frame(periods[in_range], shares[in_range].round(4)).to_html("topics_share_over_time.html")
 
 
     #########################################################################
@@ -1,20 +1,27 @@
 from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer
-from os import listdir, mkdir
+from os import listdir, mkdir, cpu_count, replace
 from os.path import join, isfile, isdir
-import PdfConverter
+from multiprocessing import Pool
+import pdf_converter
+import text_normalizer
 import pandas as pd
 from nltk.tokenize import sent_tokenize, word_tokenize
 from nltk.stem import PorterStemmer, WordNetLemmatizer
 from pathlib import Path
 import nltk
 from nltk.corpus import wordnet, stopwords
+from nltk.tag.perceptron import PerceptronTagger
 from timeit import default_timer as timer
 from collections import Counter
+from functools import lru_cache
 import time
-import re
+import signal
 
 DATA_PATH = "../data"
 CLEAN_DATA_PATH = "../clean_data"
+BACKEND = "tika"  # "tika", "pdfminer" or "pypdf"
+TIMEOUT = 300  # seconds allowed for a single pdf
+CACHE_SIZE = 2 ** 18  # distinct words remembered by the tag and lemma caches
 
 porter = PorterStemmer()
 wordnet_lemmatizer = WordNetLemmatizer()
@@ -25,18 +32,30 @@ stopwords_dict = Counter(
 
 
 def remove_special_characters(text):
-    pat = r"[^a-zA-z0-9.,!?/:;\"\'\s]"
-    return re.sub(pat, "", text)
+    return text_normalizer.SPECIAL_CHARACTERS.sub("", text)
 
 
 def remove_numbers(text):
-    pattern = r"[^a-zA-z.,!?/:;\"\'\s]"
-    return re.sub(pattern, "", text)
+    return text_normalizer.SPECIAL_CHARACTERS_AND_NUMBERS.sub("", text)
 
 
+_tagger = None
+
+
+def get_tagger():
+    """nltk.pos_tag loads the perceptron model again on every call,
+    here it is loaded once per process"""
+    global _tagger
+    if _tagger is None:
+        _tagger = PerceptronTagger()
+    return _tagger
+
+
+@lru_cache(maxsize=CACHE_SIZE)
 def get_wordnet_pos(word):
-    """Map POS tag to first character lemmatize() accepts"""
-    tag = nltk.pos_tag([word])[0][1][0].upper()
+    """Map POS tag to first character lemmatize() accepts.
+    The word is tagged on its own, same as nltk.pos_tag([word])"""
+    tag = get_tagger().tag([word])[0][1][0].upper()
     tag_dict = {
         "J": wordnet.ADJ,
         "N": wordnet.NOUN,
@@ -47,20 +66,84 @@ def get_wordnet_pos(word):
     return tag_dict.get(tag, wordnet.NOUN)
 
 
+@lru_cache(maxsize=CACHE_SIZE)
+def lemmatize_word(word, pos):
+    return wordnet_lemmatizer.lemmatize(word, pos)
+
+
 def lemmatize_text(text):
     token_words = word_tokenize(text)
     lemmatized_text = []
     for word in token_words:
-        lemmatized_text.append(
-            wordnet_lemmatizer.lemmatize(word, get_wordnet_pos(word))
-        )
+        lemmatized_text.append(lemmatize_word(word, get_wordnet_pos(word)))
         lemmatized_text.append(" ")
     return "".join(lemmatized_text)
 
 
-def lemmatize_pdfs():
+class ConversionTimeout(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise ConversionTimeout()
+
+
+def clean_pdf(pdf_path, cleaned_pdf_path, backend, timeout):
+    """Convert one pdf to lemmatized text, runs in a worker process.
+    SIGALRM interrupts a pdf that takes longer than `timeout` seconds,
+    so a single pathological file does not stall its worker.
+    Without SIGALRM (Windows) or with timeout None only the Tika
+    request is limited by the timeout."""
+    use_alarm = timeout is not None and hasattr(signal, "SIGALRM")
+    try:
+        if use_alarm:
+            signal.signal(signal.SIGALRM, _raise_timeout)
+            signal.alarm(max(1, int(timeout)))
+        single_pdf_txt = pdf_converter.convert_pdf_to_string(
+            pdf_path, backend, timeout
+        ).lower()
+        # remove_special_characters followed by remove_numbers, in one pass
+        single_pdf_txt = text_normalizer.strip_special_characters(single_pdf_txt)
+
+        lemmatized_pdf = lemmatize_text(single_pdf_txt)
+
+        cleaned_pdf = " ".join(
+            [
+                word
+                for word in lemmatized_pdf.split()
+                if word not in stopwords_dict
+            ]
+        )
+
+        # written to a hidden file first, isfile() in lemmatize_pdfs only
+        # sees complete txt files and the catalog and preprocessing skip
+        # hidden files, same as preprocessing.preprocess_file
+        cleaned_pdf_path = Path(cleaned_pdf_path)
+        partial_path = cleaned_pdf_path.with_name(f".{cleaned_pdf_path.name}.tmp")
+        with open(partial_path, "w+") as text_file:
+            text_file.write(cleaned_pdf)
+        replace(partial_path, cleaned_pdf_path)
+        return pdf_path, None
+    except Exception as e:
+        return pdf_path, repr(e)
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+
+
+def _clean_pdf(args):
+    return clean_pdf(*args)
+
+
+def lemmatize_pdfs(workers=cpu_count(), backend=BACKEND, timeout=TIMEOUT):
+    """Convert every pdf in DATA_PATH which has no txt in CLEAN_DATA_PATH yet.
+    workers - number of processes converting pdfs in parallel
+    backend - pdf_converter backend ("tika", "pdfminer" or "pypdf")
+    timeout - seconds after which a single pdf is given up, None for no limit
+    The tika backend needs a running Tika server, see pdf_converter.TIKA_SERVER"""
     if not (isdir("../clean_data")):
         mkdir("../clean_data")
+    jobs = []
     for year in listdir(DATA_PATH):
         if not (isdir(f"../clean_data/{year}")):
             mkdir(f"../clean_data/{year}")
@@ -70,38 +153,23 @@ def lemmatize_pdfs():
                 mkdir(f"../clean_data/{year}/{month}")
 
             for pdf_file in listdir(join(join(DATA_PATH, year), month)):
+                # skip unfinished downloads (.pdf.part) and rejected files (.pdf.corrupt)
+                if not pdf_file.endswith(".pdf"):
+                    continue
                 cleaned_pdf_path = Path(
                     join(join(join(CLEAN_DATA_PATH, year), month), pdf_file)
                 ).with_suffix(".txt")
                 if not isfile(cleaned_pdf_path):
-                    try:
-                        pdf_path = join(
-                            join(join(DATA_PATH, year), month), pdf_file
-                        )
-                        single_pdf_txt = PdfConverter.convert_pdf_to_string(
-                            pdf_path
-                        ).lower()
-                        single_pdf_txt = remove_special_characters(
-                            single_pdf_txt
-                        )
-
-                        single_pdf_txt = remove_numbers(single_pdf_txt)
-
-                        lemmatized_pdf = lemmatize_text(single_pdf_txt)
-
-                        cleaned_pdf = " ".join(
-                            [
-                                word
-                                for word in lemmatized_pdf.split()
-                                if word not in stopwords_dict
-                            ]
-                        )
-
-                        with open(cleaned_pdf_path, "w+") as text_file:
-                            text_file.write(cleaned_pdf)
+                    pdf_path = join(join(join(DATA_PATH, year), month), pdf_file)
+                    jobs.append((pdf_path, cleaned_pdf_path, backend, timeout))
 
-                    except Exception as e:
-                        print(e.__cause__)
+    if backend == "tika" and jobs:
+        pdf_converter.check_tika_server()
+    with Pool(workers) as pool:
+        for pdf_path, error in pool.imap_unordered(_clean_pdf, jobs):
+            if error:
+                print(pdf_path, error)
 
 
-lemmatize_pdfs()
+if __name__ == "__main__":
+    lemmatize_pdfs()
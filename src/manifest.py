@@ -0,0 +1,235 @@
+import calendar
+import sqlite3
+import threading
+import time
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+# papers announced in the first days of a month can still carry the
+# id of the previous one, a month is only closed once they are listed
+CLOSE_DELAY = 7 * 24 * 3600
+
+
+def month_end(year, month):
+    """
+    Timestamp (UTC) after which the listing of year/month is complete
+    """
+
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return calendar.timegm((next_year, next_month, 1, 0, 0, 0)) + CLOSE_DELAY
+
+
+class Manifest:
+    """
+    Per paper record of the scraping progress, kept in SQLite
+
+    Every paper seen on a listing page is stored under its arXiv id
+    together with its status, size, sha256 checksum and timestamps,
+    so resuming skips finished papers with a single key lookup and
+    retries only the failed ones.
+
+    Database : manifest.db
+    """
+
+    def __init__(self, path: str = "manifest.db"):
+        """
+        path : sqlite database file, created when missing
+        """
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS items (
+                    arxiv_id TEXT PRIMARY KEY,
+                    year INTEGER NOT NULL,
+                    month INTEGER NOT NULL,
+                    title TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    size INTEGER,
+                    sha256 TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+                """
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS items_month ON items (year, month, status)"
+            )
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS months (
+                    year INTEGER NOT NULL,
+                    month INTEGER NOT NULL,
+                    listed REAL NOT NULL,
+                    PRIMARY KEY (year, month)
+                )
+                """
+            )
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS harvests (
+                    source TEXT PRIMARY KEY,
+                    until TEXT NOT NULL,
+                    updated REAL NOT NULL
+                )
+                """
+            )
+
+    def close(self):
+        self.connection.close()
+
+    def add_items(self, year, month, items):
+        """
+        items : (arxiv_id, title, url) tuples listed for year/month,
+                papers already in the manifest keep their status
+        """
+
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                """
+                INSERT OR IGNORE INTO items
+                    (arxiv_id, year, month, title, url, status, created, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    (arxiv_id, year, month, title, url, PENDING, now, now)
+                    for arxiv_id, title, url in items
+                ],
+            )
+
+    def mark_listed(self, year, month):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO months (year, month, listed) VALUES (?, ?, ?)",
+                (year, month, time.time()),
+            )
+
+    def is_listed(self, year, month):
+        """
+        True once the month was listed after it was over, a month listed
+        while papers could still be added to it has to be listed again
+        """
+
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT listed FROM months WHERE year = ? AND month = ?", (year, month)
+            ).fetchone()
+        return row is not None and row[0] >= month_end(year, month)
+
+    def open_months(self):
+        """
+        (year, month) of every month listed before it was over
+        """
+
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT year, month, listed FROM months ORDER BY year, month"
+            ).fetchall()
+        return [(year, month) for year, month, listed in rows if listed < month_end(year, month)]
+
+    def last_harvest(self, source):
+        """
+        Day (YYYY-MM-DD) up to which `source` was harvested, None if never
+        """
+
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT until FROM harvests WHERE source = ?", (source,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def mark_harvested(self, source, until):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO harvests (source, until, updated) VALUES (?, ?, ?)",
+                (source, until, time.time()),
+            )
+
+    def mark_done(self, arxiv_id, size, sha256):
+        with self.lock, self.connection:
+            self.connection.execute(
+                """
+                UPDATE items
+                SET status = ?, size = ?, sha256 = ?, error = NULL,
+                    attempts = attempts + 1, updated = ?
+                WHERE arxiv_id = ?
+                """,
+                (DONE, size, sha256, time.time(), arxiv_id),
+            )
+
+    def mark_failed(self, arxiv_id, error):
+        with self.lock, self.connection:
+            self.connection.execute(
+                """
+                UPDATE items
+                SET status = ?, error = ?, attempts = attempts + 1, updated = ?
+                WHERE arxiv_id = ?
+                """,
+                (FAILED, error, time.time(), arxiv_id),
+            )
+
+    def status(self, arxiv_id):
+        """
+        Status of the paper, None when it was never listed
+        """
+
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT status FROM items WHERE arxiv_id = ?", (arxiv_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def missing(self, year=None, month=None):
+        """
+        (arxiv_id, year, month, title, url) of every paper that is
+        not downloaded yet, optionally restricted to year/month
+        """
+
+        query = (
+            "SELECT arxiv_id, year, month, title, url FROM items WHERE status != ?"
+        )
+        parameters = [DONE]
+        if year is not None:
+            query += " AND year = ?"
+            parameters.append(year)
+        if month is not None:
+            query += " AND month = ?"
+            parameters.append(month)
+        with self.lock:
+            return self.connection.execute(
+                query + " ORDER BY arxiv_id", parameters
+            ).fetchall()
+
+    def failed(self):
+        """
+        (arxiv_id, year, month, title, url, error) of every failed paper
+        """
+
+        with self.lock:
+            return self.connection.execute(
+                "SELECT arxiv_id, year, month, title, url, error FROM items "
+                "WHERE status = ? ORDER BY arxiv_id",
+                (FAILED,),
+            ).fetchall()
+
+    def summary(self, year, month):
+        """
+        {status: number of papers} for year/month
+        """
+
+        with self.lock:
+            return dict(
+                self.connection.execute(
+                    "SELECT status, COUNT(*) FROM items "
+                    "WHERE year = ? AND month = ? GROUP BY status",
+                    (year, month),
+                ).fetchall()
+            )
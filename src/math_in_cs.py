@@ -7,27 +7,18 @@ import numpy as np
 import pandas as pd
 from sklearn.feature_extraction.text import TfidfVectorizer
 
+import catalog
+
 
 def get_file_paths(CLEAN_DATA_DIR: str) -> pd.DataFrame:
     """
-    Given a the clean_data directory, it returns dataframe containing year, month and filepath.
+    Given a the clean_data directory, it returns dataframe containing year, month and filepath,
+    read from the corpus catalog and ordered by year, month and file name.
     :param CLEAN_DATA_DIR: path to clean_data folder
     :return: dataframe with columns year, month, path
     """
-    documents = pd.DataFrame(
-        [
-            {
-                "year": int(year),
-                "month": int(month),
-                "path": os.path.join(CLEAN_DATA_DIR, year, month, file),
-            }
-            for year in os.listdir(CLEAN_DATA_DIR)
-            for month in os.listdir(os.path.join(CLEAN_DATA_DIR, year))
-            for file in os.listdir(os.path.join(CLEAN_DATA_DIR, year, month))
-            if os.path.isfile(os.path.join(CLEAN_DATA_DIR, year, month, file))
-        ]
-    )
-    return documents
+    documents = catalog.get_documents(CLEAN_DATA_DIR)
+    return documents[["year", "month", "path"]]
 
 
 def parse_xml_to_df(path: str) -> pd.DataFrame:
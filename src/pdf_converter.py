@@ -5,11 +5,75 @@ Created on Sat Oct 24 19:56:26 2020
 @author: Pina
 """
 
-from tika import parser
+import os
 
+import requests
 
-def convert_pdf_to_string(file_path):
+# The "tika" backend sends the pdfs to a Tika server which has to be running
+# already, nothing starts one (e.g. java -jar tika-server-standard.jar --port 9998).
+# Its URL is taken from TIKA_SERVER_ENDPOINT, as in the tika package.
+TIKA_SERVER = os.environ.get("TIKA_SERVER_ENDPOINT", "http://localhost:9998")
 
-    rawText = parser.from_file(file_path)
-    rawList = rawText["content"]
-    return rawList
+# One pooled session per process, reused for every document
+_tika_session = None
+
+
+def convert_with_tika(file_path, timeout=None, server=None):
+    """Send the pdf to a running Tika server (TIKA_SERVER by default) and return its text"""
+
+    global _tika_session
+    if _tika_session is None:
+        _tika_session = requests.Session()
+    with open(file_path, "rb") as pdf:
+        response = _tika_session.put(
+            f"{(server or TIKA_SERVER).rstrip('/')}/tika",
+            data=pdf,
+            headers={"Accept": "text/plain"},
+            timeout=timeout,
+        )
+    response.raise_for_status()
+    return response.text
+
+
+def check_tika_server(server=None, timeout=5):
+    """Fail fast when no Tika server answers, instead of one error per pdf"""
+
+    url = f"{(server or TIKA_SERVER).rstrip('/')}/tika"
+    try:
+        requests.get(url, timeout=timeout).raise_for_status()
+    except requests.RequestException as e:
+        raise RuntimeError(
+            f"No Tika server at {url} ({e!r}). Start one, e.g. "
+            "java -jar tika-server-standard.jar --port 9998, set "
+            "TIKA_SERVER_ENDPOINT, or use another backend"
+        ) from e
+
+
+def convert_with_pdfminer(file_path, timeout=None):
+    from pdfminer.high_level import extract_text
+
+    return extract_text(file_path)
+
+
+def convert_with_pypdf(file_path, timeout=None):
+    from pypdf import PdfReader
+
+    with open(file_path, "rb") as pdf:
+        reader = PdfReader(pdf)
+        return "\n".join(page.extract_text() or "" for page in reader.pages)
+
+
+BACKENDS = {
+    "tika": convert_with_tika,
+    "pdfminer": convert_with_pdfminer,
+    "pypdf": convert_with_pypdf,
+}
+
+
+def convert_pdf_to_string(file_path, backend="tika", timeout=None):
+    """
+    backend : "tika", "pdfminer" or "pypdf"
+    timeout : seconds to wait for the Tika server, None waits forever
+    """
+
+    return BACKENDS[backend](file_path, timeout)
@@ -3,11 +3,12 @@ Place unzipped clean_data folder in IML-Project/ folder and run this script
 to perform simple preprocessing on txt files.
 """
 import itertools
+import multiprocessing
 import os
-import re
 import shutil
 import num2words
 from spacy.lang.en.stop_words import STOP_WORDS
+from text_normalizer import normalize
 
 
 def move(destination):
@@ -40,10 +41,37 @@ def flatten(path=os.path.join(os.path.dirname(os.getcwd()), "clean_data")):
                             )
 
 
-def preprocess_txt(path=os.path.join(os.path.dirname(os.getcwd()), "clean_data")):
+def preprocess_file(file_path):
+    """Preprocess a single txt file in place. The result goes to a hidden
+    temporary file which then replaces the original, so an interrupted
+    run never leaves a truncated document.
+    Input: file_path - path to txt file"""
+    with open(file_path, "r") as f:
+        no_stop_words = normalize(f.read(), STOP_WORDS)
+    directory, name = os.path.split(file_path)
+    tmp_path = os.path.join(directory, f".{name}.tmp")
+    with open(tmp_path, "w") as w:
+        w.write(no_stop_words)
+    os.replace(tmp_path, file_path)
+    return file_path
+
+
+def preprocess_txt(
+    path=os.path.join(os.path.dirname(os.getcwd()), "clean_data"), processes=None
+):
     """Remove non letters, words shorter than 3 letters or longer
     than 20 letters, and multiple spaces.
-    Input: path - path to clean_data folder"""
+    Files are processed in parallel and every finished file is appended
+    to <path>.done, so running the script again skips them.
+    Input: path - path to clean_data folder
+           processes - number of worker processes, all cores by default"""
+    done_path = path.rstrip(os.sep) + ".done"
+    done = set()
+    if os.path.isfile(done_path):
+        with open(done_path) as d:
+            done = set(d.read().splitlines())
+
+    files = []
     for year in os.listdir(path):
         year_path = os.path.join(path, year)
         if os.path.isdir(year_path):
@@ -51,23 +79,21 @@ def preprocess_txt(path=os.path.join(os.path.dirname(os.getcwd()), "clean_data")
                 month_path = os.path.join(path, year, month)
                 if os.path.isdir(month_path):
                     for file in os.listdir(month_path):
-                        f = open(os.path.join(path, year, month, file), "r")
-                        letters_only = re.sub(r"[^a-zA-Z\s]", " ", f.read())
-                        no_singletons = re.sub(r"\b\w{1,2}\b", " ", letters_only)
-                        no_long_words = re.sub(r"\b[a-zA-Z]{20,}\b", " ", no_singletons)
-                        single_spaces = re.compile(r"\s{2,}").sub(" ", no_long_words)
-                        no_stop_words = " ".join(
-                            filter(
-                                lambda x: x not in STOP_WORDS,
-                                single_spaces.split(sep=" "),
-                            )
-                        )
-                        w = open(os.path.join(path, year, month, file), "w")
-                        w.write(no_stop_words)
-                        f.close()
-                        w.close()
+                        file_path = os.path.join(path, year, month, file)
+                        if file.startswith(".") and file.endswith(".tmp"):
+                            # left behind by an interrupted run
+                            os.remove(file_path)
+                        elif os.path.join(year, month, file) not in done:
+                            files.append(file_path)
+
+    with multiprocessing.Pool(processes) as pool, open(done_path, "a") as d:
+        for file_path in pool.imap_unordered(preprocess_file, files, chunksize=16):
+            d.write(os.path.relpath(file_path, path) + "\n")
+            d.flush()
 
 
 STOP_WORDS |= set([num2words.num2words(x) for x in range(100)])
-flatten()
-preprocess_txt()
+
+if __name__ == "__main__":
+    flatten()
+    preprocess_txt()
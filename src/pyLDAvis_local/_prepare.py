@@ -6,14 +6,16 @@ Main transformation functions for preparing LDAdata to the visualization's data
 
 from __future__ import absolute_import
 from past.builtins import basestring
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import hashlib
 import json
 import logging
 from joblib import Parallel, delayed, cpu_count
 import numpy as np
 import pandas as pd
 from scipy.stats import entropy
-from scipy.spatial.distance import pdist, squareform
+from scipy.special import xlogy
+from scipy.linalg import eigh
 from .utils import NumPyEncoder
 try:
     from sklearn.manifold import MDS, TSNE
@@ -70,6 +72,65 @@ def _jensen_shannon(_P, _Q):
     return 0.5 * (entropy(_P, _M) + entropy(_Q, _M))
 
 
+def _js_distance_matrix(distributions, dtype=np.float64, block_size=2 ** 22):
+    """Jensen-Shannon divergence between every pair of rows of `distributions`,
+    same as ``squareform(pdist(distributions, metric=_jensen_shannon))``.
+
+    Uses JS(P, Q) = H(M) - (H(P) + H(Q)) / 2 with M = (P + Q) / 2, so only the
+    entropies of the mixtures are computed per pair, one row against a block
+    of rows at a time, with about `block_size` elements per block.
+
+    Parameters
+    ----------
+    distributions : array-like, shape (`n_dists`, `k`)
+        Matrix of distributions probabilities.
+    dtype : np.float64 or np.float32
+        Precision of the mixtures, float32 halves memory and time, the
+        entropies are always summed in float64.
+
+    Returns
+    -------
+    dist_matrix : array, shape (`n_dists`, `n_dists`)
+    """
+    P = np.asarray(distributions, dtype)
+    P = P / P.sum(axis=1, keepdims=True)
+    n, k = P.shape
+    neg_entropy = xlogy(P, P).sum(axis=1, dtype=np.float64)
+    rows = max(1, block_size // k)
+    dist_matrix = np.zeros((n, n))
+    for i in range(n - 1):
+        for start in range(i + 1, n, rows):
+            M = P[start:start + rows] + P[i]
+            M *= 0.5
+            dist_matrix[i, start:start + rows] = 0.5 * (neg_entropy[i] + neg_entropy[start:start + rows]) \
+                                                 - xlogy(M, M).sum(axis=1, dtype=np.float64)
+    np.maximum(dist_matrix, 0, out=dist_matrix)
+    return dist_matrix + dist_matrix.T
+
+
+# distance matrices of the last topic_term_dists passed to prepare, by hash
+_dist_cache = OrderedDict()
+_DIST_CACHE_SIZE = 4
+
+
+def _topic_dists_key(topic_term_dists):
+   values = np.ascontiguousarray(topic_term_dists, np.float64)
+   return hashlib.sha1(values.tobytes() + str(values.shape).encode()).hexdigest()
+
+
+def _cached_js_distance_matrix(topic_term_dists):
+   key = _topic_dists_key(topic_term_dists)
+   if key in _dist_cache:
+      _dist_cache.move_to_end(key)
+   else:
+      _dist_cache[key] = _js_distance_matrix(topic_term_dists)
+      # shared by every prepare of the same model, writing to it would corrupt the cache
+      _dist_cache[key].setflags(write=False)
+      if len(_dist_cache) > _DIST_CACHE_SIZE:
+         _dist_cache.popitem(last=False)
+   return _dist_cache[key]
+
+
 def _pcoa(pair_dists, n_components=2):
     """Principal Coordinate Analysis,
     aka Classical Multidimensional Scaling
@@ -78,19 +139,23 @@ def _pcoa(pair_dists, n_components=2):
     # https://github.com/biocore/scikit-bio/blob/0.5.0/skbio/stats/ordination/_principal_coordinate_analysis.py
 
     # pairwise distance matrix is assumed symmetric
-    pair_dists = np.asarray(pair_dists, np.float64)
-
-    # perform SVD on double centred distance matrix
-    n = pair_dists.shape[0]
-    H = np.eye(n) - np.ones((n, n)) / n
-    B = - H.dot(pair_dists ** 2).dot(H) / 2
-    eigvals, eigvecs = np.linalg.eig(B)
-
-    # Take first n_components of eigenvalues and eigenvectors
-    # sorted in decreasing order
-    ix = eigvals.argsort()[::-1][:n_components]
-    eigvals = eigvals[ix]
-    eigvecs = eigvecs[:, ix]
+    B = np.array(pair_dists, np.float64)
+
+    # double centre -D^2 / 2 in place, same as H B H with H = I - 1/n,
+    # without building H
+    n = B.shape[0]
+    B **= 2
+    B *= -0.5
+    row_means = B.mean(axis=1)
+    B -= row_means[:, np.newaxis]
+    B -= row_means[np.newaxis, :]
+    B += row_means.mean()
+
+    # B is symmetric, only its largest n_components eigenpairs are computed,
+    # in decreasing order
+    eigvals, eigvecs = eigh(B, subset_by_index=[max(n - n_components, 0), n - 1], overwrite_a=True)
+    eigvals = eigvals[::-1]
+    eigvecs = eigvecs[:, ::-1]
 
     # replace any remaining negative eigenvalues and associated eigenvectors with zeroes
     # at least 1 eigenvalue must be zero
@@ -103,7 +168,7 @@ def _pcoa(pair_dists, n_components=2):
     return np.sqrt(eigvals) * eigvecs
 
 
-def js_PCoA(distributions):
+def js_PCoA(distributions, dist_matrix=None):
     """Dimension reduction via Jensen-Shannon Divergence & Principal Coordinate Analysis
     (aka Classical Multidimensional Scaling)
 
@@ -112,15 +177,19 @@ def js_PCoA(distributions):
     distributions : array-like, shape (`n_dists`, `k`)
         Matrix of distributions probabilities.
 
+    dist_matrix : array, shape (`n_dists`, `n_dists`), optional
+        Precomputed Jensen-Shannon distances between the distributions.
+
     Returns
     -------
     pcoa : array, shape (`n_dists`, 2)
     """
-    dist_matrix = squareform(pdist(distributions, metric=_jensen_shannon))
+    if dist_matrix is None:
+        dist_matrix = _js_distance_matrix(distributions)
     return _pcoa(dist_matrix)
 
 
-def js_MMDS(distributions, **kwargs):
+def js_MMDS(distributions, dist_matrix=None, **kwargs):
     """Dimension reduction via Jensen-Shannon Divergence & Metric Multidimensional Scaling
 
     Parameters
@@ -128,18 +197,22 @@ def js_MMDS(distributions, **kwargs):
     distributions : array-like, shape (`n_dists`, `k`)
         Matrix of distributions probabilities.
 
+    dist_matrix : array, shape (`n_dists`, `n_dists`), optional
+        Precomputed Jensen-Shannon distances between the distributions.
+
     **kwargs : Keyword argument to be passed to `sklearn.manifold.MDS()`
 
     Returns
     -------
     mmds : array, shape (`n_dists`, 2)
     """
-    dist_matrix = squareform(pdist(distributions, metric=_jensen_shannon))
+    if dist_matrix is None:
+        dist_matrix = _js_distance_matrix(distributions)
     model = MDS(n_components=2, random_state=0, dissimilarity='precomputed', **kwargs)
     return model.fit_transform(dist_matrix)
 
 
-def js_TSNE(distributions, **kwargs):
+def js_TSNE(distributions, dist_matrix=None, **kwargs):
     """Dimension reduction via Jensen-Shannon Divergence & t-distributed Stochastic Neighbor Embedding
 
     Parameters
@@ -147,13 +220,17 @@ def js_TSNE(distributions, **kwargs):
     distributions : array-like, shape (`n_dists`, `k`)
         Matrix of distributions probabilities.
 
+    dist_matrix : array, shape (`n_dists`, `n_dists`), optional
+        Precomputed Jensen-Shannon distances between the distributions.
+
     **kwargs : Keyword argument to be passed to `sklearn.manifold.TSNE()`
 
     Returns
     -------
     tsne : array, shape (`n_dists`, 2)
     """
-    dist_matrix = squareform(pdist(distributions, metric=_jensen_shannon))
+    if dist_matrix is None:
+        dist_matrix = _js_distance_matrix(distributions)
     model = TSNE(n_components=2, random_state=0, metric='precomputed', **kwargs)
     return model.fit_transform(dist_matrix)
 
@@ -178,9 +255,12 @@ def _series_with_name(data, name):
       return pd.Series(data, name=name)
 
 
-def _topic_coordinates(mds, topic_term_dists, topic_proportion):
+def _topic_coordinates(mds, topic_term_dists, topic_proportion, dist_matrix=None):
    K = topic_term_dists.shape[0]
-   mds_res = mds(topic_term_dists)
+   if dist_matrix is not None and mds in (js_PCoA, js_MMDS, js_TSNE):
+      mds_res = mds(topic_term_dists, dist_matrix=dist_matrix)
+   else:
+      mds_res = mds(topic_term_dists)
    assert mds_res.shape == (K, 2)
    mds_df = pd.DataFrame({'x': mds_res[:,0], 'y': mds_res[:,1], 'topics': range(1, K + 1), \
                           'cluster': 1, 'Freq': topic_proportion * 100})
@@ -196,27 +276,75 @@ def _chunks(l, n):
 
 
 def _job_chunks(l, n_jobs=1):
-   n_jobs= 1
+   """ Split l into as many chunks as the jobs joblib runs for `n_jobs`.
+   """
    n_chunks = n_jobs
    if n_jobs < 0:
-      # so, have n chunks if we are using all n cores/cpus
-      n_chunks = cpu_count() + 1 - n_jobs
+      # so, have n chunks if we are using all n cores/cpus (-1), all but one (-2), ...
+      n_chunks = max(cpu_count() + 1 + n_jobs, 1)
+   n_chunks = min(n_chunks, len(l))
 
-   return _chunks(l, n_chunks)
+   return _chunks(l, -(-len(l) // n_chunks))
 
 
-def _find_relevance(log_ttd, log_lift, R, lambda_):
-   relevance = lambda_ * log_ttd + (1 - lambda_) * log_lift
-   return relevance.T.apply(lambda s: s.sort_values(ascending=False).index).head(R)
+def _top_terms(relevance, R):
+   # indices of the R largest values, largest first
+   if len(relevance) > R:
+      top = np.argpartition(relevance, len(relevance) - R)[-R:]
+   else:
+      top = np.arange(len(relevance))
+   return top[np.argsort(-relevance[top], kind='stable')]
+
+
+def _find_relevance(relevance, R, previous=None):
+   """Indices of the R most relevant terms of every topic, most relevant first,
+   as an array of shape (`n_topics`, `R`).
+
+   `previous` are the top terms for a close lambda: the least relevant of them is
+   a lower bound of the R-th largest relevance, so only the few terms above it
+   are ranked instead of the whole vocabulary."""
+   top = np.empty((relevance.shape[0], R), dtype=np.intp)
+   if previous is None:
+      for k, topic_relevance in enumerate(relevance):
+         top[k] = _top_terms(topic_relevance, R)
+      return top
+   threshold = np.take_along_axis(relevance, previous, axis=1).min(axis=1)
+   rows, candidates = np.divmod(np.flatnonzero(relevance >= threshold[:, np.newaxis]), relevance.shape[1])
+   bounds = np.searchsorted(rows, np.arange(relevance.shape[0] + 1))
+   for k, topic_relevance in enumerate(relevance):
+      topic_candidates = candidates[bounds[k]:bounds[k + 1]]
+      if len(topic_candidates) < R:
+         # only with NaN among the previous top terms
+         top[k] = _top_terms(topic_relevance, R)
+      else:
+         top[k] = topic_candidates[_top_terms(topic_relevance[topic_candidates], R)]
+   return top
 
 
 def _find_relevance_chunks(log_ttd, log_lift, R, lambda_seq):
-   return pd.concat([_find_relevance(log_ttd, log_lift, R, l) for l in lambda_seq])
+   # shape (`n_lambdas`, `n_topics`, `R`), lambda_seq is sorted so every
+   # ranking starts from the one of the previous lambda
+   top_terms = np.empty((len(lambda_seq), log_ttd.shape[0], R), dtype=np.intp)
+   relevance = np.empty_like(log_ttd)
+   weighted_lift = np.empty_like(log_lift)
+   # log(0) gives NaN relevance at lambda 0 or 1
+   finite = np.isfinite(log_ttd).all() and np.isfinite(log_lift).all()
+   previous = None
+   # -inf * 0 and -inf + inf only make the NaN handled below
+   with np.errstate(invalid="ignore"):
+      for i, lambda_ in enumerate(lambda_seq):
+         np.multiply(log_ttd, lambda_, out=relevance)
+         np.multiply(log_lift, 1 - lambda_, out=weighted_lift)
+         relevance += weighted_lift
+         if not finite:
+            # ranked last, like pandas sorts NaN
+            relevance[np.isnan(relevance)] = -np.inf
+         top_terms[i] = previous = _find_relevance(relevance, R, previous)
+   return top_terms
 
 
 def _topic_info(topic_term_dists, topic_proportion, term_frequency, term_topic_freq, vocab, lambda_step, R, n_jobs=1):
    # marginal distribution over terms (width of blue bars)
-   n_jobs =1
    term_proportion = term_frequency / term_frequency.sum()
 
    # compute the distinctiveness and saliency of the terms:
@@ -239,24 +367,36 @@ def _topic_info(topic_term_dists, topic_proportion, term_frequency, term_topic_f
    default_term_info['logprob'] = default_term_info['loglift'] = ranks
 
    ## compute relevance and top terms for each topic
-   log_lift = np.log(topic_term_dists / term_proportion)
-   log_ttd = np.log(topic_term_dists)
+   log_lift = np.log(np.asarray(topic_term_dists) / np.asarray(term_proportion))
+   log_ttd = np.log(np.asarray(topic_term_dists))
    lambda_seq = np.arange(0, 1 + lambda_step, lambda_step)
 
-   def topic_top_term_df(tup):
-      new_topic_id, (original_topic_id, topic_terms) = tup
-      term_ix = topic_terms.unique()
-      return pd.DataFrame({'Term': vocab[term_ix], \
-                           'Freq': term_topic_freq.loc[original_topic_id, term_ix], \
-                           'Total': term_frequency[term_ix], \
-                           'logprob': log_ttd.loc[original_topic_id, term_ix].round(4), \
-                           'loglift': log_lift.loc[original_topic_id, term_ix].round(4), \
-                           'Category': 'Topic%d' % new_topic_id})
-
-   top_terms = pd.concat(Parallel(n_jobs=n_jobs)(delayed(_find_relevance_chunks)(log_ttd, log_lift, R, ls) \
-                                                 for ls in _job_chunks(lambda_seq, n_jobs)))
-   topic_dfs = map(topic_top_term_df, enumerate(top_terms.T.iterrows(), 1))
-   return pd.concat([default_term_info] + list(topic_dfs))
+   # shape (`n_lambdas`, `n_topics`, `R`), every job ranks a contiguous part of the lambda grid.
+   # log_ttd and log_lift are dumped once and memory mapped read only by the workers
+   # instead of being pickled for every job
+   top_terms = np.concatenate(Parallel(n_jobs=n_jobs, max_nbytes='1M', mmap_mode='r') \
+                              (delayed(_find_relevance_chunks)(log_ttd, log_lift, R, ls) \
+                               for ls in _job_chunks(lambda_seq, n_jobs)))
+
+   # the distinct top terms of every topic, in the order they first appear
+   # going through the lambdas
+   topic_ix, term_ix = [], []
+   for k in range(top_terms.shape[1]):
+      terms = top_terms[:, k, :].ravel()
+      _, first = np.unique(terms, return_index=True)
+      term_ix.append(terms[np.sort(first)])
+      topic_ix.append(np.full(len(first), k))
+   topic_ix = np.concatenate(topic_ix)
+   term_ix = np.concatenate(term_ix)
+
+   topic_term_info = pd.DataFrame({'Term': np.asarray(vocab)[term_ix], \
+                                   'Freq': np.asarray(term_topic_freq)[topic_ix, term_ix], \
+                                   'Total': np.asarray(term_frequency)[term_ix], \
+                                   'logprob': log_ttd[topic_ix, term_ix].round(4), \
+                                   'loglift': log_lift[topic_ix, term_ix].round(4), \
+                                   'Category': ['Topic%d' % (k + 1) for k in topic_ix]}, \
+                                  index=term_ix)
+   return pd.concat([default_term_info, topic_term_info])
 
 
 def _token_table(topic_info, term_topic_freq, vocab, term_frequency):
@@ -288,7 +428,7 @@ def _token_table(topic_info, term_topic_freq, vocab, term_frequency):
 
 def prepare(topic_term_dists, doc_topic_dists, doc_lengths, vocab, term_frequency, \
             R=30, lambda_step=0.01, mds=js_PCoA, n_jobs=1, \
-            plot_opts={'xlab': 'PC1', 'ylab': 'PC2'}, sort_topics=True):
+            plot_opts={'xlab': 'PC1', 'ylab': 'PC2'}, sort_topics=True, dist_matrix=None):
    """Transforms the topic model distributions and related corpus data into
    the data structures needed for the visualization.
 
@@ -323,12 +463,19 @@ def prepare(topic_term_dists, doc_topic_dists, doc_lengths, vocab, term_frequenc
         if `sklearn` package is installed for the latter two.
     n_jobs : int
         The number of cores to be used to do the computations. The regular
-        joblib conventions are followed so `-1`, which is the default, will
-        use all cores.
+        joblib conventions are followed so `-1` will use all cores.
+        The lambda grid of the relevance computation is split into one
+        chunk per core. Default is 1.
     plot_opts : dict, with keys 'xlab' and `ylab`
         Dictionary of plotting options, right now only used for the axis labels.
     sort_topics : sort topics by topic proportion (percentage of tokens covered). Set to false to
         to keep original topic order.
+    dist_matrix : array-like, shape (`n_topics`, `n_topics`), optional
+        Jensen-Shannon distances between the rows of `topic_term_dists`, e.g. the
+        `dist_matrix` of a previous result for the same model. Otherwise it is computed
+        for the built-in `mds` functions and kept in memory, keyed by a hash of
+        `topic_term_dists`, so preparing the same model again with another `mds`
+        only runs the projection.
 
     Returns
     -------
@@ -368,6 +515,11 @@ def prepare(topic_term_dists, doc_topic_dists, doc_lengths, vocab, term_frequenc
          logging.warning('Unknown mds `%s`, switch to PCoA' % mds)
          mds = js_PCoA
 
+   if dist_matrix is None and mds in (js_PCoA, js_MMDS, js_TSNE):
+      dist_matrix = _cached_js_distance_matrix(topic_term_dists)
+   if dist_matrix is not None:
+      dist_matrix = np.asarray(dist_matrix)
+
    topic_term_dists = _df_with_names(topic_term_dists, 'topic', 'term')
    doc_topic_dists  = _df_with_names(doc_topic_dists, 'doc', 'topic')
    term_frequency   = _series_with_name(term_frequency, 'term_frequency')
@@ -399,13 +551,17 @@ def prepare(topic_term_dists, doc_topic_dists, doc_lengths, vocab, term_frequenc
 
    topic_info         = _topic_info(topic_term_dists, topic_proportion, term_frequency, term_topic_freq, vocab, lambda_step, R, n_jobs)
    token_table        = _token_table(topic_info, term_topic_freq, vocab, term_frequency)
-   topic_coordinates = _topic_coordinates(mds, topic_term_dists, topic_proportion)
+   sorted_dist_matrix = None if dist_matrix is None else dist_matrix[np.ix_(topic_order, topic_order)]
+   topic_coordinates = _topic_coordinates(mds, topic_term_dists, topic_proportion, sorted_dist_matrix)
    client_topic_order = [x + 1 for x in topic_order]
 
-   return PreparedData(topic_coordinates, topic_info, token_table, R, lambda_step, plot_opts, client_topic_order)
+   return PreparedData(topic_coordinates, topic_info, token_table, R, lambda_step, plot_opts, client_topic_order,
+                       dist_matrix)
 
 class PreparedData(namedtuple('PreparedData', ['topic_coordinates', 'topic_info', 'token_table',\
-                                               'R', 'lambda_step', 'plot_opts', 'topic_order'])):
+                                               'R', 'lambda_step', 'plot_opts', 'topic_order', 'dist_matrix'],
+                              defaults=(None,))):
+    # dist_matrix (in the order of the topics given to prepare) is not part of the visualization
     def to_dict(self):
        return {'mdsDat': self.topic_coordinates.to_dict(orient='list'),
                'tinfo': self.topic_info.to_dict(orient='list'),
@@ -1,12 +1,75 @@
 import requests
 import logging
-from bs4 import BeautifulSoup
-import urllib
-from os.path import isdir, isfile
-from os import mkdir
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from os.path import isdir, isfile, getsize
+from os import mkdir, remove, replace
+from manifest import Manifest
+from harvester import iter_listing, iter_oai_records
+from datetime import date
+from itertools import groupby
+import hashlib
 import pickle
+import threading
 import time
-import random
+
+HEADERS = {
+    "Accept-Encoding": "gzip, deflate, sdch",
+    "Accept-Language": "en-US,en;q=0.8",
+    "Upgrade-Insecure-Requests": "1",
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.87 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+    "Cache-Control": "max-age=0",
+    "Connection": "keep-alive",
+}
+
+# PDFs are requested without compression so that Content-Length
+# matches the number of bytes written to disk
+DOWNLOAD_HEADERS = {"Accept": "application/pdf", "Accept-Encoding": "identity"}
+CHUNK_SIZE = 64 * 1024
+PDF_MAGIC = b"%PDF"
+# every complete PDF ends with this marker, possibly followed by a few line ends
+PDF_EOF = b"%%EOF"
+
+
+class DownloadError(Exception):
+    pass
+
+
+class TokenBucket:
+    """
+    Token bucket limiting the rate of requests sent to one host
+
+    rate     : tokens added per second (sustained requests per second)
+    capacity : maximum number of tokens (allowed burst)
+    """
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available and take it
+        """
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.timestamp) * self.rate,
+                )
+                self.timestamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
 
 
 class scraper:
@@ -15,25 +78,67 @@ class scraper:
     the script was running for weeks to scrape the resulting
     dataset
 
+    Downloads run in a thread pool sharing one keep-alive
+    session, so throughput is bounded by the per host rate
+    limit and not by serial round-trips.
+
+    In "listing" mode every month listing is paged through in full,
+    in "oai" mode the metadata is harvested once through OAI-PMH and
+    later runs only fetch the records changed since the last harvest.
+
     Target website          : http://export.arxiv.org/
-    Delay between requests  : 1s
+    Requests per second     : 1 per host (token bucket)
+    Downloads in flight     : 4
     Data dumped in          : ../data
     Logger                  : scraper.log
     Variables               : vars.pkl
+    Per paper progress      : manifest.db
     """
 
-    def __init__(self, start_date: str, end_date: str, resume: bool):
+    def __init__(
+        self,
+        start_date: str,
+        end_date: str,
+        resume: bool,
+        max_workers: int = 4,
+        rate: float = 1.0,
+        burst: int = 1,
+        mode: str = "listing",
+        base_url: str = "http://export.arxiv.org",
+    ):
         """
-        start_date : which year to start with
-        end_year   : which year to end with
-        resume     : use variables saved in pkl and resume
-                     from that point
+        start_date  : which year to start with
+        end_year    : which year to end with
+        resume      : use variables saved in pkl and resume
+                      from that point
+        max_workers : maximum number of downloads in flight
+        rate        : requests per second allowed for each host
+        burst       : requests allowed at once for each host
+        mode        : "listing" (monthly html listings) or "oai" (OAI-PMH)
+        base_url    : arXiv mirror to scrape
         """
 
         # Initialising variables
         self.year_index = start_date
         self.month_index = 1
         self.pdf_count = 0
+        self.max_workers = max_workers
+        self.rate = rate
+        self.burst = burst
+        self.mode = mode
+        self.base_url = base_url
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.manifest = Manifest("manifest.db")
+
+        # Pooled keep-alive connections shared by all the workers
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        adapter = HTTPAdapter(
+            pool_connections=max_workers, pool_maxsize=max_workers
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
         # Creating a folder to hold all the data
         if not isdir("../data"):
@@ -66,7 +171,7 @@ class scraper:
             level=logging.INFO,
             filename="scraper.log",
             filemode="a+",
-            format="%(asctime)-15s %(levelname)-8s %(message)s",
+            format="%(asctime)-15s %(levelname)-8s %(threadName)s %(message)s",
         )
 
     def get_variables(self):
@@ -90,37 +195,210 @@ class scraper:
                 f,
             )
 
-    def download_file(self, download_url, pdf_title, path):
+    def get_bucket(self, url):
+        """
+        Token bucket of the host the url points to
+        """
+
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.burst)
+            return self.buckets[host]
+
+    def get(self, url, **kwargs):
+        """
+        Rate limited GET through the shared session
+        """
+
+        self.get_bucket(url).acquire()
+        return self.session.get(url, **kwargs)
+
+    def download_file(self, download_url, pdf_title, path, arxiv_id):
         """
         download_url : automatic download link
         pdf_title    : name of the file that will be saved
         path         : exact path to use (year/month)
+        arxiv_id     : key of the paper in the manifest
+
+        The PDF is streamed into {pdf_title}.pdf.part and renamed
+        into place only once it is complete, so an existing .pdf is
+        always a full file. A leftover .part file is resumed with
+        an HTTP Range request.
         """
 
+        pdf_path = f"{path}/{pdf_title}.pdf"
+        part_path = pdf_path + ".part"
         try:
-            req = requests.get(
-                download_url,
-                headers={
-                    "Accept-Encoding": "gzip, deflate, sdch",
-                    "Accept-Language": "en-US,en;q=0.8",
-                    "Upgrade-Insecure-Requests": "1",
-                    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.87 Safari/537.36",
-                    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-                    "Cache-Control": "max-age=0",
-                    "Connection": "keep-alive",
-                },
+            offset = getsize(part_path) if isfile(part_path) else 0
+            checksum = hashlib.sha256()
+            if offset:
+                with open(part_path, "rb") as file:
+                    for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                        checksum.update(chunk)
+            headers = dict(DOWNLOAD_HEADERS)
+            if offset:
+                headers["Range"] = f"bytes={offset}-"
+
+            expected = None
+            with self.get(download_url, headers=headers, stream=True) as req:
+                if offset and req.status_code == 416:
+                    # The .part file already holds the whole PDF
+                    pass
+                else:
+                    req.raise_for_status()
+                    if offset and req.status_code != 206:
+                        # Server ignored the range, start from scratch
+                        offset = 0
+                        checksum = hashlib.sha256()
+                    expected = req.headers.get("Content-Length")
+                    expected = offset + int(expected) if expected else None
+
+                    with open(part_path, "ab" if offset else "wb") as file:
+                        for chunk in req.iter_content(chunk_size=CHUNK_SIZE):
+                            file.write(chunk)
+                            checksum.update(chunk)
+
+            size = getsize(part_path)
+            if expected is not None and size != expected:
+                raise DownloadError(
+                    f"truncated download, got {size} of {expected} bytes"
+                )
+            with open(part_path, "rb") as file:
+                if file.read(len(PDF_MAGIC)) != PDF_MAGIC:
+                    remove(part_path)
+                    raise DownloadError("response is not a PDF")
+
+            replace(part_path, pdf_path)
+            self.manifest.mark_done(arxiv_id, size, checksum.hexdigest())
+            with self.lock:
+                self.pdf_count += 1
+            self.logger.info(
+                f"[Arxiv] [Added PDF] ({self.pdf_count}) {pdf_title}"
             )
-            file = open(f"{path}/{pdf_title}.pdf", "wb")
-            file.write(req.content)
-            file.close()
-            self.pdf_count += 1
         except Exception as ex:
             exception_str = type(ex).__name__
             exception_args = ex.args
+            self.manifest.mark_failed(arxiv_id, f"{exception_str}: {exception_args}")
             self.logger.exception(
                 f"[Arxiv] {exception_str} Args: {exception_args} Paper : {pdf_title}"
             )
 
+    def register_file(self, download_url, pdf_title, path, arxiv_id):
+        """
+        Record a PDF downloaded before the manifest existed.
+        Those files were written without any check, a file that does not
+        start with %PDF or does not end with %%EOF (an error page or a
+        truncated download) is renamed to .corrupt and downloaded again
+        """
+
+        pdf_path = f"{path}/{pdf_title}.pdf"
+        checksum = hashlib.sha256()
+        with open(pdf_path, "rb") as file:
+            valid = file.read(len(PDF_MAGIC)) == PDF_MAGIC
+            file.seek(0)
+            tail = b""
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                checksum.update(chunk)
+                tail = (tail + chunk)[-1024:]
+        if not valid or PDF_EOF not in tail:
+            self.logger.warning(f"[CORRUPT] : {pdf_path}")
+            replace(pdf_path, pdf_path + ".corrupt")
+            return self.download_file(download_url, pdf_title, path, arxiv_id)
+        self.manifest.mark_done(arxiv_id, getsize(pdf_path), checksum.hexdigest())
+
+    def get_listing(self, year, month):
+        """
+        Returns (arxiv id, title, download link) listed for the given month
+        """
+
+        self.logger.warning(f"[NEW PAGE] : {year}/{month}")
+        return list(iter_listing(self.get, self.base_url, year, month))
+
+    def harvest_oai(self):
+        """
+        Add the papers changed since the previous harvest to the manifest
+        """
+
+        from_date = self.manifest.last_harvest("oai") or f"{self.start_date}-01-01"
+        until_date = date.today().isoformat()
+        self.logger.warning(f"[OAI] harvesting {from_date} to {until_date}")
+        records = (
+            record
+            for record in iter_oai_records(
+                self.get, self.base_url, from_date, until_date
+            )
+            if self.start_date <= record[3] < self.end_date
+        )
+        for (year, month), items in groupby(records, key=lambda r: r[3:]):
+            self.manifest.add_items(year, month, [item[:3] for item in items])
+        self.manifest.mark_harvested("oai", until_date)
+
+    def scrape_month(self, executor, year, month):
+        """
+        List year/month unless it was listed after it was over and
+        download every paper of it that is still missing
+        """
+
+        for folder in (f"../data/{year}", f"../data/{year}/{month}"):
+            if not isdir(folder):
+                mkdir(folder)
+
+        # Once a month is over its listing is fetched a last time, afterwards
+        # the manifest knows which of its papers are still missing.
+        # Papers already in the manifest keep their status.
+        if not self.manifest.is_listed(year, month):
+            self.manifest.add_items(year, month, self.get_listing(year, month))
+            self.manifest.mark_listed(year, month)
+
+        futures = [
+            self.submit(executor, *item) for item in self.manifest.missing(year, month)
+        ]
+        for future in as_completed(futures):
+            future.result()
+
+    def submit(self, executor, arxiv_id, year, month, pdf_title, download_link):
+        """
+        Schedule the download of one paper from the manifest
+        """
+
+        path = f"../data/{year}/{month}"
+        if isfile(f"{path}/{pdf_title}.pdf"):
+            return executor.submit(
+                self.register_file, download_link, pdf_title, path, arxiv_id
+            )
+        return executor.submit(
+            self.download_file, download_link, pdf_title, path, arxiv_id
+        )
+
+    def download_all(self, items):
+        """
+        items : (arxiv_id, year, month, title, url) from the manifest
+        """
+
+        with ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="download"
+        ) as executor:
+            futures = []
+            for arxiv_id, year, month, pdf_title, download_link in items:
+                for folder in (f"../data/{year}", f"../data/{year}/{month}"):
+                    if not isdir(folder):
+                        mkdir(folder)
+                futures.append(
+                    self.submit(
+                        executor, arxiv_id, year, month, pdf_title, download_link
+                    )
+                )
+            for future in as_completed(futures):
+                future.result()
+
+    def retry_failed(self):
+        """
+        Download again every paper that failed in any month
+        """
+
+        self.download_all(item[:5] for item in self.manifest.failed())
+
     def start(self):
         """
         Start scraping using the specified parameters
@@ -131,67 +409,54 @@ class scraper:
         print(self.end_date)
         print(type(self.end_date))
 
-        while self.year_index < self.end_date:
+        if self.mode == "oai":
+            # Months are not visited one by one, the manifest already
+            # knows every paper that is still missing
+            self.harvest_oai()
+            self.download_all(
+                item
+                for item in self.manifest.missing()
+                if self.start_date <= item[1] < self.end_date
+            )
+            return
 
-            if not isdir(f"../data/{self.year_index}"):
-                mkdir(f"../data/{self.year_index}")
+        with ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="download"
+        ) as executor:
+            # Months already passed by a previous run but listed before they
+            # were over get the papers added to them since then
+            for year, month in self.manifest.open_months():
+                if self.start_date <= year < self.end_date and (year, month) < (
+                    self.year_index,
+                    self.month_index,
+                ):
+                    self.scrape_month(executor, year, month)
 
-            while self.month_index < 13:
+            while self.year_index < self.end_date:
 
-                if not isdir(f"../data/{self.year_index}/{self.month_index}"):
-                    mkdir(f"../data/{self.year_index}/{self.month_index}")
+                if not isdir(f"../data/{self.year_index}"):
+                    mkdir(f"../data/{self.year_index}")
 
-                year_str = str(self.year_index)[2] + str(self.year_index)[3]
-                base_link = requests.get(
-                    f"http://export.arxiv.org/list/cs/{year_str}{self.month_index:02}?skip=0&show=500",
-                    headers={
-                        "Accept-Encoding": "gzip, deflate, sdch",
-                        "Accept-Language": "en-US,en;q=0.8",
-                        "Upgrade-Insecure-Requests": "1",
-                        "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.87 Safari/537.36",
-                        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-                        "Cache-Control": "max-age=0",
-                        "Connection": "keep-alive",
-                    },
-                )
-                self.logger.warn("[NEW PAGE] : " + base_link.url)
-                page_soup = BeautifulSoup(base_link.text, "html.parser")
-                pdf_titles = page_soup.findAll("dd")
-                pdf_links = page_soup.findAll("dt")
-                for title, link in zip(pdf_titles, pdf_links):
-
-                    pdf_link = link.find("a", {"title": "Download PDF"})
-                    pdf_title = (
-                        title.text.split("Title: ")[1].split("Authors")[0]
-                    )[:-3]
-                    if pdf_link and not isfile(
-                        f"../data/{self.year_index}/{self.month_index}/{pdf_title}.pdf"
-                    ):
-                        download_link = (
-                            "http://export.arxiv.org/" + pdf_link["href"]
-                        )
-                        self.download_file(
-                            download_link,
-                            pdf_title,
-                            path=f"../data/{self.year_index}/{self.month_index}",
-                        )
-                        time.sleep(random.randint(1, 3))
-                        self.logger.info(
-                            f"[Arxiv] [Added PDF] ({self.pdf_count}) {pdf_title}"
-                        )
-                    self.pdf_count += 1
-
-                self.month_index += 1
+                while self.month_index < 13:
+
+                    # The month is saved in vars.pkl only once all of its
+                    # downloads have finished, so resuming never skips a paper
+                    self.scrape_month(executor, self.year_index, self.month_index)
+
+                    self.logger.warning(
+                        f"[Arxiv] [NEW MONTH] : {self.year_index}/{self.month_index}"
+                    )
+                    self.month_index += 1
+                    self.pdf_count = 0
+                    self.update_variables()
+
+                self.logger.warning(f"[Arxiv] [NEW YEAR] : {self.year_index}")
+                self.year_index += 1
                 self.pdf_count = 0
+                self.month_index = 1
                 self.update_variables()
-                self.logger.warn("[Arxiv] [NEW MONTH] : " + base_link.url)
-
-            self.year_index += 1
-            self.pdf_count = 0
-            self.month_index = 1
-            self.update_variables()
-            self.logger.warn("[Arxiv] [NEW YEAR] : " + base_link.url)
 
 
-my_scraper = scraper(2015, 2020, True)
-my_scraper.start()
+if __name__ == "__main__":
+    my_scraper = scraper(2015, 2020, True)
+    my_scraper.start()
@@ -0,0 +1,141 @@
+"""
+Single pass text normalization shared by lemmatizer.py and preprocessing.py.
+
+Run this script to compare it with the original chain of re.sub calls on
+the clean_data corpus (both outputs are checked to be identical).
+"""
+import os
+import re
+import sys
+import time
+
+LETTERS = re.compile(r"[a-zA-Z]+")
+GLUED_WORDS = re.compile(r"[a-zA-Z][^\S ][a-zA-Z]")
+LONE_WHITESPACE = frozenset("\t\n\r\x0b\x0c\x1c\x1d\x1e\x1f\x85\xa0\u1680\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a\u2028\u2029\u202f\u205f\u3000")
+# A-z on purpose, the lemmatizer always kept [ \ ] ^ _ ` as well
+SPECIAL_CHARACTERS = re.compile(r"[^a-zA-z0-9.,!?/:;\"\'\s]")
+SPECIAL_CHARACTERS_AND_NUMBERS = re.compile(r"[^a-zA-z.,!?/:;\"\'\s]")
+MIN_WORD_LENGTH = 3
+MAX_WORD_LENGTH = 19
+
+
+def strip_special_characters(text):
+    """Same as removing special characters and then numbers, in one pass"""
+    return SPECIAL_CHARACTERS_AND_NUMBERS.sub("", text)
+
+
+def _kept(word):
+    return MIN_WORD_LENGTH <= len(word) <= MAX_WORD_LENGTH
+
+
+def normalize(text, stop_words=frozenset()):
+    """Remove non letters, words shorter than 3 letters or longer
+    than 19 letters, multiple spaces and stop words.
+
+    Gives the same result as substituting [^a-zA-Z\\s], \\b\\w{1,2}\\b,
+    \\b[a-zA-Z]{20,}\\b and \\s{2,} one after another, splitting on
+    single spaces and dropping stop words.
+
+    Usually the words are just the letter runs of the right length.
+    Only a lone newline or tab between two words (or at either end)
+    glues them into one token, those texts go through _normalize_scan."""
+    if not text or text[0] in LONE_WHITESPACE or text[-1] in LONE_WHITESPACE:
+        return _normalize_scan(text, stop_words)
+    if GLUED_WORDS.search(text):
+        return _normalize_scan(text, stop_words)
+    runs = LETTERS.findall(text)
+    tokens = [word for word in runs if _kept(word)]
+    if not tokens:
+        return _normalize_scan(text, stop_words)
+    # text not starting (ending) with a kept word starts (ends) with a gap,
+    # which splitting on spaces turns into an empty token
+    if not (text.startswith(runs[0]) and _kept(runs[0])):
+        tokens.insert(0, "")
+    if not (text.endswith(runs[-1]) and _kept(runs[-1])):
+        tokens.append("")
+    return " ".join([token for token in tokens if token not in stop_words])
+
+
+def _normalize_scan(text, stop_words=frozenset()):
+    """normalize() in a single scan of the text which handles every case.
+    Between two kept words there is either a single whitespace
+    character, kept as it is, or a longer gap, written as one space."""
+    tokens = []
+    current = []
+    gap_length = 0
+    gap_character = ""
+    position = 0
+
+    def close_gap():
+        nonlocal current
+        if gap_length == 1 and gap_character != " ":
+            # a lone newline or tab does not split the token
+            current.append(gap_character)
+        elif gap_length:
+            token = "".join(current)
+            if token not in stop_words:
+                tokens.append(token)
+            current = []
+
+    for match in LETTERS.finditer(text):
+        start, end = match.span()
+        if start > position:
+            gap_length += start - position
+            gap_character = text[position] if text[position].isspace() else " "
+        position = end
+        if not MIN_WORD_LENGTH <= end - start <= MAX_WORD_LENGTH:
+            gap_length += 1
+            gap_character = " "
+            continue
+        close_gap()
+        gap_length = 0
+        current.append(match.group())
+
+    if len(text) > position:
+        gap_length += len(text) - position
+        gap_character = text[position] if text[position].isspace() else " "
+    close_gap()
+    token = "".join(current)
+    if token not in stop_words:
+        tokens.append(token)
+    return " ".join(tokens)
+
+
+def _normalize_with_regexes(text, stop_words=frozenset()):
+    """The original implementation of preprocessing.preprocess_txt"""
+    letters_only = re.sub(r"[^a-zA-Z\s]", " ", text)
+    no_singletons = re.sub(r"\b\w{1,2}\b", " ", letters_only)
+    no_long_words = re.sub(r"\b[a-zA-Z]{20,}\b", " ", no_singletons)
+    single_spaces = re.compile(r"\s{2,}").sub(" ", no_long_words)
+    return " ".join(
+        filter(lambda x: x not in stop_words, single_spaces.split(sep=" "))
+    )
+
+
+def benchmark(path=os.path.join(os.path.dirname(os.getcwd()), "clean_data")):
+    """Time both implementations on every txt file below path"""
+    texts = []
+    for root, _dirs, files in os.walk(path):
+        for filename in files:
+            with open(os.path.join(root, filename)) as f:
+                texts.append(f.read())
+
+    from spacy.lang.en.stop_words import STOP_WORDS
+
+    start = time.perf_counter()
+    expected = [_normalize_with_regexes(text, STOP_WORDS) for text in texts]
+    regexes = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = [normalize(text, STOP_WORDS) for text in texts]
+    single_pass = time.perf_counter() - start
+
+    assert result == expected, "outputs differ"
+    size = sum(map(len, texts)) / 2 ** 20
+    print(f"{len(texts)} files, {size:.1f} MiB")
+    print(f"re.sub chain : {regexes:.2f} s")
+    print(f"single pass  : {single_pass:.2f} s ({regexes / single_pass:.2f}x)")
+
+
+if __name__ == "__main__":
+    benchmark(*sys.argv[1:])
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+pytest.importorskip("pandas")
+
+import catalog  # noqa: E402
+
+
+def test_full_refresh_sees_file_rewritten_in_place(tmp_path):
+    month = tmp_path / "clean_data" / "2018" / "7"
+    month.mkdir(parents=True)
+    (month / "paper.txt").write_text("x")
+    db_path = str(tmp_path / "catalog.db")
+    catalog.refresh(str(tmp_path / "clean_data"), db_path)
+
+    folder_mtime = os.stat(month).st_mtime
+    (month / "paper.txt").write_text("longer text")
+    # rewriting a file does not touch the folder, make sure of it
+    os.utime(month, (folder_mtime, folder_mtime))
+
+    # a quick refresh only looks at the folders
+    documents = catalog.get_documents(str(tmp_path / "clean_data"), db_path)
+    assert documents["size"].tolist() == [len("x")]
+
+    documents = catalog.get_documents(str(tmp_path / "clean_data"), db_path, full=True)
+    assert documents.doc_id.tolist() == ["2018/7/paper.txt"]
+    assert documents["size"].tolist() == [len("longer text")]
@@ -0,0 +1,158 @@
+"""
+harvester.py against a local http.server that plays the arXiv listing
+pages and the OAI-PMH endpoint
+"""
+
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+requests = pytest.importorskip("requests")
+pytest.importorskip("bs4")
+
+from harvester import id_to_date, iter_listing, iter_oai_records, parse_listing  # noqa: E402
+
+ENTRY = """
+<dt><a href="/abs/{id}" title="Abstract">arXiv:{id}</a>
+ [<a href="/pdf/{id}" title="Download PDF">pdf</a>]</dt>
+<dd><div class="list-title">Title: {title}\n\n\nAuthors: Someone</div></dd>
+"""
+
+LISTING_PAGES = {
+    "0": [("1807.00001", "First paper"), ("1807.00002", "Second paper")],
+    "2": [("1807.00003", "Third paper")],
+}
+
+OAI_RECORD = """
+<record><header{status}><identifier>oai:arXiv.org:{id}</identifier></header>
+<metadata><arXiv xmlns="http://arxiv.org/OAI/arXiv/"><id>{id}</id>
+<title>{title}</title></arXiv></metadata></record>
+"""
+
+OAI_PAGE = """<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+<ListRecords>{records}{token}</ListRecords>
+</OAI-PMH>
+"""
+
+NO_RECORDS = """<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+<error code="noRecordsMatch">No records</error>
+</OAI-PMH>
+"""
+
+
+def oai_page(records, token):
+    return OAI_PAGE.format(
+        records="".join(
+            OAI_RECORD.format(id=arxiv_id, title=title, status=status)
+            for arxiv_id, title, status in records
+        ),
+        token=token,
+    )
+
+
+OAI_PAGES = {
+    None: oai_page(
+        [
+            ("1807.00001", "First\n   paper", ""),
+            ("1807.00009", "Withdrawn", ' status="deleted"'),
+        ],
+        '<resumptionToken cursor="0" completeListSize="3">page2</resumptionToken>',
+    ),
+    "page2": oai_page(
+        [("cs/0701001", "Old style id", "")],
+        '<resumptionToken cursor="2" completeListSize="3"/>',
+    ),
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        Handler.requests.append((url.path, query))
+        if url.path == "/list/cs/1807":
+            entries = LISTING_PAGES.get(query["skip"], [])
+            body = "<p>Computer Science: total of 3 entries</p><dl>{}</dl>".format(
+                "".join(ENTRY.format(id=arxiv_id, title=title) for arxiv_id, title in entries)
+            )
+            self.reply(body, "text/html")
+        elif url.path == "/oai2":
+            if query.get("from") == "2030-01-01":
+                self.reply(NO_RECORDS, "text/xml")
+            else:
+                self.reply(OAI_PAGES[query.get("resumptionToken")], "text/xml")
+        else:
+            self.send_error(404)
+
+    def reply(self, body, content_type):
+        data = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def base_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    Handler.requests = []
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_id_to_date():
+    assert id_to_date("1807.01234") == (2018, 7)
+    assert id_to_date("cs/0701001") == (2007, 1)
+
+
+def test_parse_listing():
+    html = "<p>total of 3 entries</p><dl>{}</dl>".format(
+        ENTRY.format(id="1807.00001", title="First paper")
+    )
+    assert parse_listing(html) == ([("1807.00001", "First paper", "/pdf/1807.00001")], 3)
+
+
+def test_iter_listing_stops_at_total(base_url):
+    entries = list(iter_listing(requests.get, base_url, 2018, 7, show=2))
+
+    assert entries == [
+        ("1807.00001", "First paper", f"{base_url}/pdf/1807.00001"),
+        ("1807.00002", "Second paper", f"{base_url}/pdf/1807.00002"),
+        ("1807.00003", "Third paper", f"{base_url}/pdf/1807.00003"),
+    ]
+    # two pages for 3 entries, no request for an empty third page
+    assert [query["skip"] for _, query in Handler.requests] == ["0", "2"]
+
+
+def test_iter_oai_records_follows_resumption_token(base_url):
+    records = list(iter_oai_records(requests.get, base_url, "2018-07-01", "2018-07-31"))
+
+    assert records == [
+        ("1807.00001", "First paper", f"{base_url}/pdf/1807.00001", 2018, 7),
+        ("cs/0701001", "Old style id", f"{base_url}/pdf/cs/0701001", 2007, 1),
+    ]
+    first, second = (query for _, query in Handler.requests)
+    assert first["from"] == "2018-07-01" and first["until"] == "2018-07-31"
+    # the resumption request carries the token only
+    assert second == {"verb": "ListRecords", "resumptionToken": "page2"}
+
+
+def test_iter_oai_records_no_records_match(base_url):
+    assert list(iter_oai_records(requests.get, base_url, "2030-01-01")) == []
@@ -0,0 +1,59 @@
+import glob
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, ROOT)
+
+for module in ("numpy", "scipy", "pandas", "gensim", "matplotlib", "wordcloud", "pyLDAvis"):
+    pytest.importorskip(module)
+
+from gensim import models  # noqa: E402
+from gensim.corpora import Dictionary  # noqa: E402
+from gensim.models import CoherenceModel  # noqa: E402
+from gensim.test.utils import common_corpus, common_dictionary  # noqa: E402
+from scipy import sparse  # noqa: E402
+
+import lda  # noqa: E402
+
+
+@pytest.mark.parametrize("topn", [3, 5, 10])
+def test_u_mass_coherence_matches_coherence_model(tmp_path, topn):
+    model = models.LdaModel(common_corpus, id2word=common_dictionary, num_topics=4, random_state=1, passes=5)
+    fname = str(tmp_path / "occurrence.npz")
+    lda.document_occurrence(common_corpus, len(common_dictionary), fname)
+
+    expected = CoherenceModel(model=model, corpus=common_corpus, dictionary=common_dictionary,
+                              coherence="u_mass", topn=topn).get_coherence()
+    assert lda.u_mass_coherence(sparse.load_npz(fname), model.get_topics(), topn=topn) == pytest.approx(expected)
+
+
+def test_run_sweep_keys_depend_on_lda_kwargs(tmp_path):
+    output_dir = str(tmp_path / "sweep")
+    one_pass = lda.run_sweep(common_dictionary, common_corpus, [2], output_dir=output_dir, cpu_budget=1,
+                             passes=1, random_state=1)
+    two_passes = lda.run_sweep(common_dictionary, common_corpus, [2], output_dir=output_dir, cpu_budget=1,
+                               passes=2, random_state=1)
+
+    assert one_pass.key[0] != two_passes.key[0]
+    assert one_pass.model_file[0] != two_passes.model_file[0]
+    assert os.path.isfile(one_pass.model_file[0]) and os.path.isfile(two_passes.model_file[0])
+
+
+def test_run_sweep_keys_depend_on_corpus_and_dictionary(tmp_path):
+    output_dir = str(tmp_path / "sweep")
+    first = lda.run_sweep(common_dictionary, common_corpus, [2], output_dir=output_dir, cpu_budget=1,
+                          passes=1, random_state=1)
+
+    texts = [["apple", "banana"], ["banana", "cherry", "date"], ["apple", "date", "fig", "grape"]]
+    dictionary = Dictionary(texts)
+    corpus = [dictionary.doc2bow(text) for text in texts]
+    second = lda.run_sweep(dictionary, corpus, [2], output_dir=output_dir, cpu_budget=1,
+                           passes=1, random_state=1)
+
+    assert first.key[0] != second.key[0]
+    assert len(glob.glob(os.path.join(output_dir, "occurrence_*.npz"))) == 2
+    assert models.LdaModel.load(second.model_file[0]).num_terms == len(dictionary)
@@ -0,0 +1,33 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import manifest  # noqa: E402
+from manifest import Manifest, month_end  # noqa: E402
+
+
+def test_month_listed_while_open_is_listed_again(tmp_path, monkeypatch):
+    db = Manifest(str(tmp_path / "manifest.db"))
+
+    # listed in the middle of July 2018
+    monkeypatch.setattr(manifest.time, "time", lambda: month_end(2018, 6) + 8 * 24 * 3600)
+    db.mark_listed(2018, 7)
+    assert not db.is_listed(2018, 7)
+    assert db.open_months() == [(2018, 7)]
+
+    # listed again once July is over
+    monkeypatch.setattr(manifest.time, "time", lambda: month_end(2018, 7))
+    db.mark_listed(2018, 7)
+    assert db.is_listed(2018, 7)
+    assert db.open_months() == []
+
+
+def test_relisting_keeps_status(tmp_path):
+    db = Manifest(str(tmp_path / "manifest.db"))
+    db.add_items(2018, 7, [("1807.00001", "First", "url1")])
+    db.mark_done("1807.00001", 10, "sha")
+    db.add_items(2018, 7, [("1807.00001", "First", "url1"), ("1807.00002", "Second", "url2")])
+
+    assert db.status("1807.00001") == "done"
+    assert [item[0] for item in db.missing(2018, 7)] == ["1807.00002"]